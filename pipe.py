@@ -5,138 +5,861 @@
 # 106074 - Rodrigo Perestrelo
 
 import sys
+import os
+import glob
+import time
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import struct
+import multiprocessing
+import multiprocessing.connection
+import signal
 import numpy as np
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from search import (
     Problem,
     Node,
+    astar_search,
+    breadth_first_graph_search,
     breadth_first_tree_search,
+    depth_first_graph_search,
+    depth_first_tree_search,
+    greedy_search,
+    parallel_depth_first_tree_search,
+    recursive_best_first_search,
 )
 
+# Representação compacta das peças: cada célula é um byte em que os 4 bits
+# menos significativos são a máscara dos lados abertos da peça e os bits 4-5
+# são o tipo da peça (F, B, V ou L).
+
+# Lados de uma célula, pela ordem dos ponteiros do relógio
+SIDE_BITS = (1, 2, 4, 8)
+OPPOSITE_SIDE = (2, 3, 0, 1)
+# Bit que a peça vizinha do lado s tem de ter aberto para se ligar a nós
+FACING_BITS = tuple(SIDE_BITS[OPPOSITE_SIDE[side]] for side in range(4))
+
+PIECE_TYPES = ('F', 'B', 'V', 'L')
+# Máscara de lados abertos de cada tipo de peça em cada orientação
+# (as orientações 2 e 3 da peça L repetem as 0 e 1)
+PIECE_MASKS = (
+    (1, 2, 4, 8),       # FC FD FB FE
+    (11, 7, 14, 13),    # BC BD BB BE
+    (9, 3, 6, 12),      # VC VD VB VE
+    (10, 5, 10, 5),     # LH LV
+)
+ORIENTATION_NAMES = (
+    ('C', 'D', 'B', 'E'),
+    ('C', 'D', 'B', 'E'),
+    ('C', 'D', 'B', 'E'),
+    ('H', 'V', 'H', 'V'),
+)
+ORIENTATION_COUNT = (4, 4, 4, 2)
+# Número de lados abertos de cada tipo de peça
+PIECE_DEGREE = (1, 3, 2, 2)
+# Ordem pela qual as orientações são experimentadas na procura
+ORIENTATION_ORDER = ((0, 2, 3, 1), (0, 2, 3, 1), (0, 2, 3, 1), (0, 1))
+
+PIECE_CODES = {}
+CODE_PIECES = [None] * 64
+CODE_ORIENTATION = [0] * 64
+# ROTATION_TABLE[code][orientation] -> código da mesma peça na orientação pedida
+ROTATION_TABLE = [None] * 64
+for pieceType in range(4):
+    codes = tuple((pieceType << 4) | mask for mask in PIECE_MASKS[pieceType])
+    for orientation in range(ORIENTATION_COUNT[pieceType]):
+        code = codes[orientation]
+        name = PIECE_TYPES[pieceType] + ORIENTATION_NAMES[pieceType][orientation]
+        PIECE_CODES[name] = code
+        CODE_PIECES[code] = name
+        CODE_ORIENTATION[code] = orientation
+        ROTATION_TABLE[code] = codes
+# VALID_CODE[byte] -> 1 se o byte é o código de uma peça
+VALID_CODE = bytearray(256)
+for code in PIECE_CODES.values():
+    VALID_CODE[code] = 1
+
+# TEXT_CODE[primeiro caráter << 8 | segundo caráter] -> código da peça com
+# esse nome no texto das instâncias (0xFF se não for uma peça)
+TEXT_CODE = bytearray(b'\xff' * 65536)
+for name, code in PIECE_CODES.items():
+    TEXT_CODE[(ord(name[0]) << 8) | ord(name[1])] = code
+# TEXT_SPACE[byte] -> 1 se o byte separa peças no texto das instâncias
+TEXT_SPACE = bytearray(256)
+for space in b' \t\n\r\v\f':
+    TEXT_SPACE[space] = 1
+
+# CODE_ROTATE[código] -> código da mesma peça depois de rodar o tabuleiro 90
+# graus no sentido dos ponteiros do relógio (C passa a D, D a B, ...);
+# CODE_UNROTATE desfaz a rotação e CODE_FLIP troca os lados D e E (espelho)
+CODE_ROTATE = bytearray(64)
+CODE_UNROTATE = bytearray(64)
+CODE_FLIP = bytearray(64)
+for code in PIECE_CODES.values():
+    pieceType, mask = code & 0x30, code & 15
+    CODE_ROTATE[code] = pieceType | ((mask << 1) | (mask >> 3)) & 15
+    CODE_UNROTATE[code] = pieceType | ((mask >> 1) | (mask << 3)) & 15
+    CODE_FLIP[code] = pieceType | (mask & 5) | ((mask & 2) << 2) | ((mask & 8) >> 2)
+# As 8 simetrias do tabuleiro: espelho (ou não) seguido de 0 a 3 rotações
+SYMMETRIES = tuple((flip, turns) for flip in (False, True) for turns in range(4))
+
+# PIECE_TEXT[3 * código : 3 * código + 3] -> nome da peça seguido de um tab,
+# para escrever o texto das soluções
+PIECE_TEXT = bytearray(b'\t' * 192)
+for name, code in PIECE_CODES.items():
+    PIECE_TEXT[3 * code:3 * code + 2] = name.encode()
+
+# Formato binário das instâncias e soluções: o cabeçalho (assinatura, versão,
+# linhas, colunas) seguido de um byte por célula, linha a linha, com o código
+# da peça na representação compacta acima
+BINARY_MAGIC = b'PIPE'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sB3xII')
+
+# Os domínios das células são conjuntos de orientações ainda permitidas,
+# guardados como bitsets (bit k ligado <=> orientação k permitida)
+FULL_DOMAIN = tuple((1 << ORIENTATION_COUNT[pieceType]) - 1 for pieceType in range(4))
+DOMAIN_SIZE = tuple(bin(domain).count('1') for domain in range(16))
+# Orientação de um domínio com um único elemento (-1 nos restantes)
+DOMAIN_SINGLE = tuple(domain.bit_length() - 1 if DOMAIN_SIZE[domain] == 1 else -1
+                      for domain in range(16))
+
+# DOMAIN_BITS[domínio] -> orientações (bits) do domínio, por ordem crescente
+DOMAIN_BITS = tuple(tuple(orientation for orientation in range(4) if domain & (1 << orientation))
+                    for domain in range(16))
+
+# DOMAIN_ORIENTATIONS[tipo << 4 | domínio] -> orientações do domínio pela
+# ordem em que são experimentadas
+DOMAIN_ORIENTATIONS = [()] * 64
+# DOMAIN_MAY_OPEN / DOMAIN_MUST_OPEN[tipo << 4 | domínio] -> lados abertos em
+# pelo menos uma / em todas as orientações do domínio
+DOMAIN_MAY_OPEN = bytearray(64)
+DOMAIN_MUST_OPEN = bytearray(64)
+for pieceType in range(4):
+    for domain in range(16):
+        key = (pieceType << 4) | domain
+        DOMAIN_ORIENTATIONS[key] = tuple(orientation for orientation in ORIENTATION_ORDER[pieceType]
+                                         if domain & (1 << orientation))
+        mayOpen = 0
+        mustOpen = 15
+        for orientation in DOMAIN_ORIENTATIONS[key]:
+            mayOpen |= PIECE_MASKS[pieceType][orientation]
+            mustOpen &= PIECE_MASKS[pieceType][orientation]
+        DOMAIN_MAY_OPEN[key] = mayOpen
+        DOMAIN_MUST_OPEN[key] = mustOpen if mayOpen else 0
+
+# FITTING_DOMAIN[tipo << 8 | obrigatórios << 4 | proibidos] -> domínio das
+# orientações do tipo que abrem todos os lados obrigatórios e nenhum dos proibidos
+FITTING_DOMAIN = bytearray(1024)
+for pieceType in range(4):
+    for required in range(16):
+        for forbidden in range(16):
+            domain = 0
+            for orientation in range(ORIENTATION_COUNT[pieceType]):
+                mask = PIECE_MASKS[pieceType][orientation]
+                if (mask & required) == required and not (mask & forbidden):
+                    domain |= 1 << orientation
+            FITTING_DOMAIN[(pieceType << 8) | (required << 4) | forbidden] = domain
+
+# SINGLE_CODE[tipo << 4 | domínio] -> código da peça na orientação do domínio,
+# se o domínio tiver um único elemento (0 nos restantes)
+SINGLE_CODE = bytearray(64)
+for pieceType in range(4):
+    for domain in range(16):
+        if DOMAIN_SIZE[domain] == 1 and domain < (1 << ORIENTATION_COUNT[pieceType]):
+            SINGLE_CODE[(pieceType << 4) | domain] = (pieceType << 4) | PIECE_MASKS[pieceType][DOMAIN_SINGLE[domain]]
+
+# Vistas numpy das tabelas, para a propagação vetorizada
+DOMAIN_SIZE_NP = np.array(DOMAIN_SIZE, dtype=np.uint8)
+DOMAIN_MAY_OPEN_NP = np.frombuffer(DOMAIN_MAY_OPEN, dtype=np.uint8)
+DOMAIN_MUST_OPEN_NP = np.frombuffer(DOMAIN_MUST_OPEN, dtype=np.uint8)
+FITTING_DOMAIN_NP = np.frombuffer(FITTING_DOMAIN, dtype=np.uint8)
+SINGLE_CODE_NP = np.frombuffer(SINGLE_CODE, dtype=np.uint8)
+VALID_CODE_NP = np.frombuffer(VALID_CODE, dtype=np.uint8)
+TEXT_CODE_NP = np.frombuffer(TEXT_CODE, dtype=np.uint8)
+TEXT_SPACE_NP = np.frombuffer(TEXT_SPACE, dtype=np.uint8)
+CODE_ROTATE_NP = np.frombuffer(CODE_ROTATE, dtype=np.uint8)
+CODE_UNROTATE_NP = np.frombuffer(CODE_UNROTATE, dtype=np.uint8)
+CODE_FLIP_NP = np.frombuffer(CODE_FLIP, dtype=np.uint8)
+PIECE_TEXT_NP = np.frombuffer(PIECE_TEXT, dtype=np.uint8).reshape(64, 3)
+
+# Políticas de escolha da célula onde ramificar: 'row-major' escolhe a
+# primeira célula não fixa por ordem de linhas; 'mrv' escolhe a célula com
+# menos orientações possíveis (em caso de empate, a que tem mais vizinhas
+# fixas) e experimenta primeiro as orientações que menos restringem as vizinhas
+BRANCHING_POLICIES = ('row-major', 'mrv')
+
+# Motores de propagação disponíveis: 'worklist' revê célula a célula só os
+# vizinhos das células alteradas; 'vectorized' revê de uma vez, com operações
+# numpy, a janela retangular à volta das células alteradas até chegar a um
+# ponto fixo
+PROPAGATION_MODES = ('worklist', 'vectorized')
+
+
 class PipeManiaState:
+    """Estado da procura. Dois estados são iguais se os domínios de todas
+    as células forem iguais; o hash é o hash de Zobrist que o tabuleiro
+    mantém de forma incremental, e os domínios só são comparados quando os
+    hashes coincidem. O tabuleiro de um estado é propagado quando o estado
+    é criado (ver PipeMania.child) e não volta a ser alterado, logo o hash
+    e os domínios comparados são sempre os do tabuleiro atual."""
     state_id = 0
 
-    def __init__(self, board):
-        self.board = board
+    def __init__(self, board=None, snapshot=None):
+        # O estado guarda o tabuleiro, ou só um BoardSnapshot que partilha
+        # blocos com o do pai e é materializado quando o tabuleiro é pedido
+        self._board = board
+        self.snapshot = snapshot
+        # Filhos já criados e propagados por PipeMania.actions, por ação,
+        # até serem entregues por result (None: ainda não expandido)
+        self.children = None
         self.id = PipeManiaState.state_id
         PipeManiaState.state_id += 1
+        self.hash = None
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = self.snapshot.thaw()
+        return self._board
+
+    def isComplete(self):
+        if self._board is None:
+            return self.snapshot.isComplete()
+        return self._board.tracker.isComplete()
+
+    def heuristic(self):
+        if self._board is None:
+            return self.snapshot.heuristic()
+        return self._board.tracker.heuristic()
 
     def __lt__(self, other):
         return self.id < other.id
 
+    def domains(self):
+        """Domínios de todas as células (sem materializar o tabuleiro de um
+        estado que só tem o snapshot)."""
+        if self._board is None:
+            return b''.join(self.snapshot.domainChunks)
+        return self._board.domains
+
+    def __hash__(self):
+        if self.hash is None:
+            if self._board is None and self.snapshot.hash is not None:
+                self.hash = self.snapshot.hash
+                return self.hash
+            board = self.board
+            if board.zobrist is None:
+                board.enableHashing()
+            self.hash = board.hash
+        return self.hash
+
+    def __eq__(self, other):
+        if not isinstance(other, PipeManiaState):
+            return NotImplemented
+        return self is other or (hash(self) == hash(other) and self.domains() == other.domains())
+
+    def __getstate__(self):
+        # Os filhos são recriados por quem receber o estado
+        state = dict(self.__dict__)
+        state['children'] = None
+        return state
+
+
+# Semente das chaves de Zobrist, para os hashes serem reproduzíveis
+ZOBRIST_SEED = 71
+
+# Peso de cada ligação desencontrada na heurística (um estado com uma ligação
+# desencontrada nunca leva a uma solução)
+MISMATCH_PENALTY = 1000
+
+
+def index_array(size):
+    """array('i') com os inteiros 0 .. size - 1, construído com numpy."""
+    values = array('i')
+    values.frombytes(np.arange(size, dtype=np.int32).tobytes())
+    return values
+
+
+class ConnectivityTracker:
+    """Union-find das peças fixas de um tabuleiro. Cada componente guarda o
+    número de pontas soltas (lados abertos para vizinhos ainda não fixos),
+    o que permite testar o objetivo em O(1) e cortar logo os ramos em que
+    as peças fixas isolam uma componente sem pontas soltas que não cobre o
+    tabuleiro todo.
+
+    O enunciado só exige que as peças fiquem todas ligadas e sem fugas, por
+    isso os ciclos são aceites por omissão (o test-02 tem um). Com
+    allowCycles a False, assume-se que a solução é uma árvore e os ramos em
+    que as peças fixas fecham um ciclo também são cortados."""
+
+    def __init__(self, size, allowCycles=True):
+        self.size = size
+        self.allowCycles = allowCycles
+        # Vetores de inteiros de 32 bits (array('i')), para as cópias do
+        # tracker feitas em cada filho serem cópias de memória contígua
+        self.parent = index_array(size)
+        self.sizes = array('i', [1]) * size
+        self.openEnds = array('i', [0]) * size
+        self.fixed = bytearray(size)
+        self.fixedCount = 0
+        self.components = 0
+        self.broken = False
+        # Total de pontas soltas e de ligações desencontradas (uma peça fixa
+        # aberta para a borda ou para uma peça fixa que não aponta para ela)
+        self.openEndsTotal = 0
+        self.mismatches = 0
+        # Valores antigos (célula, pai, tamanho, pontas soltas) e contadores
+        # antes de cada fix, para o poder desfazer (None quando não é preciso)
+        self.history = None
+
+    def copy(self):
+        newTracker = ConnectivityTracker.__new__(ConnectivityTracker)
+        newTracker.size = self.size
+        newTracker.allowCycles = self.allowCycles
+        newTracker.parent = self.parent[:]
+        newTracker.sizes = self.sizes[:]
+        newTracker.openEnds = self.openEnds[:]
+        newTracker.fixed = bytearray(self.fixed)
+        newTracker.fixedCount = self.fixedCount
+        newTracker.components = self.components
+        newTracker.broken = self.broken
+        newTracker.openEndsTotal = self.openEndsTotal
+        newTracker.mismatches = self.mismatches
+        newTracker.history = None
+        return newTracker
+
+    def find(self, index):
+        # Sem compressão de caminhos, para as uniões poderem ser desfeitas
+        parent = self.parent
+        while parent[index] != index:
+            index = parent[index]
+        return index
+
+    def isComplete(self):
+        """Todas as peças estão fixas e formam uma única árvore."""
+        return self.fixedCount == self.size and self.components == 1 and not self.broken
+
+    def fix(self, index, cells, neighbours):
+        """Acrescenta a peça (já na orientação final) em index às peças fixas,
+        ligando-a às vizinhas fixas. Devolve False se o ramo deixou de poder
+        levar a uma solução."""
+
+        parent = self.parent
+        sizes = self.sizes
+        openEnds = self.openEnds
+        fixed = self.fixed
+        saved = None
+        if self.history is not None:
+            saved = [(index, parent[index], sizes[index], openEnds[index])]
+            self.history.append((saved, self.fixedCount, self.components, self.broken,
+                                 self.openEndsTotal, self.mismatches))
+
+        fixed[index] = True
+        self.fixedCount += 1
+        self.components += 1
+
+        mask = cells[index] & 15
+        adjacent = neighbours[index]
+        root = index
+        for side in range(4):
+            neighbour = adjacent[side]
+            if mask & SIDE_BITS[side]:
+                if neighbour < 0:
+                    self.broken = True
+                    self.mismatches += 1
+                elif not fixed[neighbour]:
+                    if saved is not None:
+                        saved.append((root, parent[root], sizes[root], openEnds[root]))
+                    openEnds[root] += 1
+                    self.openEndsTotal += 1
+                elif not cells[neighbour] & FACING_BITS[side]:
+                    self.broken = True
+                    self.mismatches += 1
+                else:
+                    self.openEndsTotal -= 1
+                    other = self.find(neighbour)
+                    # As duas peças já estavam ligadas: fecha um ciclo
+                    if other == root:
+                        if not self.allowCycles:
+                            self.broken = True
+                        if saved is not None:
+                            saved.append((root, parent[root], sizes[root], openEnds[root]))
+                        openEnds[root] -= 1
+                        continue
+                    if sizes[other] > sizes[root]:
+                        root, other = other, root
+                    if saved is not None:
+                        saved.append((root, parent[root], sizes[root], openEnds[root]))
+                        saved.append((other, parent[other], sizes[other], openEnds[other]))
+                    # A ponta solta da vizinha em direção a esta peça fica ligada
+                    parent[other] = root
+                    sizes[root] += sizes[other]
+                    openEnds[root] += openEnds[other] - 1
+                    self.components -= 1
+            elif neighbour >= 0 and fixed[neighbour] and cells[neighbour] & FACING_BITS[side]:
+                self.broken = True
+                self.mismatches += 1
+                self.openEndsTotal -= 1
+
+        # Componente fechada que não cobre o tabuleiro todo
+        if openEnds[root] == 0 and sizes[root] < self.size:
+            self.broken = True
+
+        return not self.broken
+
+    def heuristic(self):
+        """Estimativa do trabalho que falta: peças por fixar, mais as pontas
+        soltas das peças fixas, mais uma penalização por cada ligação
+        desencontrada."""
+        return (self.size - self.fixedCount) + self.openEndsTotal + MISMATCH_PENALTY * self.mismatches
+
+    def checkpoint(self):
+        return len(self.history)
+
+    def undo(self, checkpoint):
+        """Desfaz todos os fix feitos depois do checkpoint."""
+        history = self.history
+        parent = self.parent
+        sizes = self.sizes
+        openEnds = self.openEnds
+        while len(history) > checkpoint:
+            (saved, self.fixedCount, self.components, self.broken,
+             self.openEndsTotal, self.mismatches) = history.pop()
+            # O primeiro registo é o da própria célula, que deixa de estar fixa
+            self.fixed[saved[0][0]] = False
+            for index, oldParent, oldSize, oldOpenEnds in reversed(saved):
+                parent[index] = oldParent
+                sizes[index] = oldSize
+                openEnds[index] = oldOpenEnds
+
+
+# Número de células de cada bloco de um BoardSnapshot
+SNAPSHOT_CHUNK = 64
+
+
+def snapshot_chunks(values, base=None, changed=()):
+    """Parte values (bytearray ou array) em blocos imutáveis (bytes) de
+    SNAPSHOT_CHUNK células. Com base, só são refeitos os blocos que contêm
+    células de changed."""
+    view = memoryview(values)
+    if base is None:
+        return tuple(view[start:start + SNAPSHOT_CHUNK].tobytes()
+                     for start in range(0, len(view), SNAPSHOT_CHUNK))
+    chunks = list(base)
+    for chunk in {index // SNAPSHOT_CHUNK for index in changed}:
+        start = chunk * SNAPSHOT_CHUNK
+        chunks[chunk] = view[start:start + SNAPSHOT_CHUNK].tobytes()
+    return tuple(chunks)
+
+
+class BoardSnapshot:
+    """Cópia imutável e compacta de um tabuleiro, para os estados que ficam
+    na fronteira da procura. As células, os domínios e os vetores do
+    ConnectivityTracker são guardados em blocos de SNAPSHOT_CHUNK células e
+    o snapshot de um filho partilha com o do pai todos os blocos em que nada
+    mudou, logo a memória da fronteira cresce com o número de alterações e
+    não com estados x células. thaw reconstrói o tabuleiro completo."""
+
+    __slots__ = ('rows', 'cols', 'cellChunks', 'domainChunks', 'fixedChunks', 'parentChunks',
+                 'sizeChunks', 'openEndChunks', 'pending', 'settings', 'fixedCount',
+                 'components', 'broken', 'openEndsTotal', 'mismatches', 'cutBranch', 'hash')
+
+    def cellsArray(self):
+        """Matriz numpy (rows, cols) com as células, materializada."""
+        return np.frombuffer(b''.join(self.cellChunks), dtype=np.uint8).reshape(self.rows, self.cols)
+
+    def domainsArray(self):
+        """Matriz numpy (rows, cols) com os domínios, materializada."""
+        return np.frombuffer(b''.join(self.domainChunks), dtype=np.uint8).reshape(self.rows, self.cols)
+
+    def isComplete(self):
+        return (self.fixedCount == self.rows * self.cols and self.components == 1
+                and not self.broken)
+
+    def heuristic(self):
+        return (self.rows * self.cols - self.fixedCount) + self.openEndsTotal + MISMATCH_PENALTY * self.mismatches
+
+    def thaw(self):
+        """Reconstrói um Board independente com o conteúdo do snapshot."""
+        (neighbours, borders, propagation, globalConnectivity, branching, allowCycles,
+         zobrist) = self.settings
+        tracker = ConnectivityTracker.__new__(ConnectivityTracker)
+        tracker.size = self.rows * self.cols
+        tracker.allowCycles = allowCycles
+        tracker.fixed = bytearray(b''.join(self.fixedChunks))
+        tracker.parent = array('i')
+        tracker.parent.frombytes(b''.join(self.parentChunks))
+        tracker.sizes = array('i')
+        tracker.sizes.frombytes(b''.join(self.sizeChunks))
+        tracker.openEnds = array('i')
+        tracker.openEnds.frombytes(b''.join(self.openEndChunks))
+        tracker.fixedCount = self.fixedCount
+        tracker.components = self.components
+        tracker.broken = self.broken
+        tracker.openEndsTotal = self.openEndsTotal
+        tracker.mismatches = self.mismatches
+        tracker.history = None
+        board = Board(bytearray(b''.join(self.cellChunks)), self.rows, self.cols,
+                      neighbours, borders, tracker)
+        board.domains = bytearray(b''.join(self.domainChunks))
+        board.pending = list(self.pending)
+        board.cutBranch = self.cutBranch
+        board.propagation = propagation
+        board.globalConnectivity = globalConnectivity
+        board.branching = branching
+        board.zobrist = zobrist
+        board.hash = self.hash or 0
+        return board
+
+
+class NeighbourTable:
+    """Vizinhos das células de um tabuleiro: table[index] devolve os índices
+    dos 4 vizinhos da célula (-1 fora do tabuleiro). São calculados a partir
+    do índice e de borders, a máscara dos lados de cada célula que dão para
+    fora do tabuleiro (um byte por célula), em vez de se guardar um tuplo
+    por célula."""
+
+    __slots__ = ('cols', 'borders')
+
+    def __init__(self, rows, cols):
+        borders = np.zeros((rows, cols), dtype=np.uint8)
+        borders[0, :] |= SIDE_BITS[0]
+        borders[:, -1] |= SIDE_BITS[1]
+        borders[-1, :] |= SIDE_BITS[2]
+        borders[:, 0] |= SIDE_BITS[3]
+        self.cols = cols
+        self.borders = bytearray(borders.tobytes())
+
+    def __len__(self):
+        return len(self.borders)
+
+    def __getitem__(self, index):
+        border = self.borders[index]
+        cols = self.cols
+        return (-1 if border & 1 else index - cols, -1 if border & 2 else index + 1,
+                -1 if border & 4 else index + cols, -1 if border & 8 else index - 1)
+
 
 class Board:
     """Representação interna de um tabuleiro de PipeMania."""
 
-    def __init__(self, cells):
+    def __init__(self, cells, rows, cols, neighbours=None, borders=None, tracker=None):
+        # cells é um bytearray com uma célula por byte, linha a linha
         self.cells = cells
-        self.rows = len(cells)
-        self.cols = len(cells[0])
+        self.rows = rows
+        self.cols = cols
         self.cutBranch = False
-        rotated = [[False for _ in range(self.cols)] for _ in range(self.rows)]
-        self.rotated = np.array(rotated)
+        # domains (construído em __getattr__ quando é preciso) guarda, para
+        # cada célula, o bitset das orientações ainda permitidas; uma célula
+        # está fixa quando só lhe resta uma orientação
+        # Células cujo domínio mudou desde a última propagação
+        self.pending = []
+        # Número de revisões de domínios feitas pela propagação
+        self.revisions = 0
+        self.propagation = 'worklist'
+        # Se a propagação também usa o grafo das ligações ainda possíveis
+        self.globalConnectivity = False
+        # Política de escolha da célula onde ramificar (ver BRANCHING_POLICIES)
+        self.branching = 'row-major'
+        # Índice das células não fixas por (tamanho do domínio, vizinhas
+        # fixas), usado pela política 'mrv'; cada balde é um dict usado como
+        # conjunto ordenado por inserção. Construído só quando é preciso
+        self.buckets = None
+        self.fixedNeighbours = None
+        # Máscara (bytearray) das células onde a procura pode ramificar, para
+        # resolver uma região do tabuleiro à parte (None: todas as células)
+        self.region = None
+        # Registo das alterações (índice, domínio antigo, peça antiga) para
+        # poder desfazê-las; só é usado pela procura que altera o tabuleiro
+        # no próprio sítio (None quando não está ativo)
+        self.trail = None
+        # Chaves de Zobrist (zobrist[índice, orientação], partilhadas entre
+        # cópias) e hash dos domínios atuais, mantido a cada alteração; None
+        # enquanto ninguém precisar do hash (ver enableHashing)
+        self.zobrist = None
+        self.hash = 0
+        # As tabelas de vizinhos e de lados fora do tabuleiro não mudam
+        # durante a procura, logo são partilhadas entre cópias do tabuleiro.
+        # Tal como o tracker das ligações entre as peças já fixas, se não
+        # forem dadas só são construídas quando são precisas (ver __getattr__)
+        if neighbours is not None:
+            self.neighbours = neighbours
+            self.borders = borders
+        if tracker is not None:
+            self.tracker = tracker
+
+    def __getattr__(self, name):
+        # Só é chamado para atributos que ainda não existem: um tabuleiro que
+        # só é lido e escrito (como na conversão de formatos) nunca constrói
+        # as tabelas de vizinhos, os domínios nem o tracker
+        if name in ('neighbours', 'borders'):
+            self.neighbours = NeighbourTable(self.rows, self.cols)
+            self.borders = self.neighbours.borders
+        elif name == 'domains':
+            self.domains = bytearray(self.rows * self.cols)
+        elif name == 'tracker':
+            self.tracker = ConnectivityTracker(self.rows * self.cols)
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def copy(self):
+        newBoard = Board(bytearray(self.cells), self.rows, self.cols,
+                         self.neighbours, self.borders, self.tracker.copy())
+        newBoard.domains = bytearray(self.domains)
+        newBoard.pending = self.pending[:]
+        newBoard.revisions = self.revisions
+        newBoard.propagation = self.propagation
+        newBoard.globalConnectivity = self.globalConnectivity
+        newBoard.branching = self.branching
+        if self.buckets is not None:
+            newBoard.buckets = [dict(bucket) for bucket in self.buckets]
+            newBoard.fixedNeighbours = bytearray(self.fixedNeighbours)
+        newBoard.zobrist = self.zobrist
+        newBoard.hash = self.hash
+        return newBoard
+
+    def snapshot(self, base=None, changed=()):
+        """Devolve um BoardSnapshot do tabuleiro. Se base for o snapshot de
+        um tabuleiro de que este é cópia, e changed as células alteradas
+        desde então (incluindo as entradas do tracker), os blocos sem
+        células alteradas são partilhados com base."""
+        tracker = self.tracker
+        snapshot = BoardSnapshot()
+        snapshot.rows = self.rows
+        snapshot.cols = self.cols
+        if base is None:
+            snapshot.cellChunks = snapshot_chunks(self.cells)
+            snapshot.domainChunks = snapshot_chunks(self.domains)
+            snapshot.fixedChunks = snapshot_chunks(tracker.fixed)
+            snapshot.parentChunks = snapshot_chunks(tracker.parent)
+            snapshot.sizeChunks = snapshot_chunks(tracker.sizes)
+            snapshot.openEndChunks = snapshot_chunks(tracker.openEnds)
+        else:
+            snapshot.cellChunks = snapshot_chunks(self.cells, base.cellChunks, changed)
+            snapshot.domainChunks = snapshot_chunks(self.domains, base.domainChunks, changed)
+            snapshot.fixedChunks = snapshot_chunks(tracker.fixed, base.fixedChunks, changed)
+            snapshot.parentChunks = snapshot_chunks(tracker.parent, base.parentChunks, changed)
+            snapshot.sizeChunks = snapshot_chunks(tracker.sizes, base.sizeChunks, changed)
+            snapshot.openEndChunks = snapshot_chunks(tracker.openEnds, base.openEndChunks, changed)
+        snapshot.pending = tuple(self.pending)
+        snapshot.settings = (self.neighbours, self.borders, self.propagation, self.globalConnectivity,
+                             self.branching, tracker.allowCycles, self.zobrist)
+        snapshot.fixedCount = tracker.fixedCount
+        snapshot.components = tracker.components
+        snapshot.broken = tracker.broken
+        snapshot.openEndsTotal = tracker.openEndsTotal
+        snapshot.mismatches = tracker.mismatches
+        snapshot.cutBranch = self.cutBranch
+        snapshot.hash = self.hash if self.zobrist is not None else None
+        return snapshot
 
-    def isOnBoard(self, row, col):
-        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+    @staticmethod
+    def recordedChanges(trail, history):
+        """Índices das células cujas entradas mudaram, segundo o registo de
+        alterações do tabuleiro e o histórico do tracker."""
+        changed = {index for index, _, _ in trail}
+        for saved, _, _, _, _, _ in history:
+            changed.update(index for index, _, _, _ in saved)
+        return changed
+
+    def enableHashing(self):
+        """Gera as chaves de Zobrist do tabuleiro e calcula de raiz o hash
+        dos domínios. Cada célula tem uma chave aleatória de 64 bits por
+        orientação e a chave de um domínio é o xor das chaves das suas
+        orientações, logo uma peça fixa tem a chave da sua orientação. A
+        partir daqui o hash é atualizado em cada alteração de um domínio,
+        neste tabuleiro e nas suas cópias. Só as 4 chaves de cada célula são
+        guardadas; as dos domínios são calculadas quando são precisas."""
+        size = self.rows * self.cols
+        self.zobrist = np.random.default_rng(ZOBRIST_SEED).integers(
+            0, 1 << 63, size=(size, 4), dtype=np.uint64)
+        domains = np.frombuffer(self.domains, dtype=np.uint8)
+        self.hash = 0
+        for orientation in range(4):
+            present = ((domains >> orientation) & 1).astype(bool)
+            self.hash ^= int(np.bitwise_xor.reduce(self.zobrist[present, orientation]))
+
+    def zobristKey(self, index, domain):
+        """Chave de Zobrist do domínio domain da célula em index: o xor das
+        chaves das suas orientações. A mudança de um domínio old para new
+        altera o hash em zobristKey(index, old ^ new)."""
+        zobrist = self.zobrist
+        key = 0
+        for orientation in DOMAIN_BITS[domain]:
+            key ^= zobrist.item(index, orientation)
+        return key
+
+    def cellsArray(self):
+        """Vista numpy (sem cópia) das células, com forma (rows, cols)."""
+        return np.frombuffer(self.cells, dtype=np.uint8).reshape(self.rows, self.cols)
+
+    def domainsArray(self):
+        """Vista numpy (sem cópia) dos domínios, com forma (rows, cols)."""
+        return np.frombuffer(self.domains, dtype=np.uint8).reshape(self.rows, self.cols)
+
+    def compatiblePipes(self, mainIndex: int, comparingIndex: int, side: int):
+        """Verifica se a peça em mainIndex, aberta para o lado side, se liga
+        à peça vizinha em comparingIndex."""
+        if (comparingIndex < 0):
             return False
-        return True
-    
-    def get_value(self, row: int, col: int) -> str:
-        """Devolve o valor na respetiva posição do tabuleiro."""
-        if (self.isOnBoard(row, col)):
-            return  self.cells[row][col]
-        return None
-    
-    def compatiblePipes(self, mainTube: str, comparingPipe: str, position: str):
+        return bool(self.cells[comparingIndex] & FACING_BITS[side])
+
+    def getAdjacentPipes(self, index: int):
+        """Devolve (vizinho, lado) para cada lado aberto da peça em index."""
+        mask = self.cells[index] & 15
+        adjacent = self.neighbours[index]
+        return [(adjacent[side], side) for side in range(4) if mask & SIDE_BITS[side]]
+
+    def heuristicFull(self):
+        """Recalcula de raiz, com operações numpy sobre o tabuleiro todo, o
+        valor que o ConnectivityTracker mantém de forma incremental em
+        heuristic(); serve para verificar esse valor."""
+        cells = self.cellsArray()
+        fixed = DOMAIN_SIZE_NP[self.domainsArray()] == 1
+        masks = cells & 15
+
+        # Para cada lado: a vizinha desse lado existe, está fixa e aponta
+        # para nós (lados para fora do tabuleiro ficam a False)
+        neighbourExists = np.zeros((4,) + cells.shape, dtype=bool)
+        neighbourFixed = np.zeros((4,) + cells.shape, dtype=bool)
+        neighbourFacing = np.zeros((4,) + cells.shape, dtype=bool)
+        shifts = (
+            (np.s_[1:, :], np.s_[:-1, :]),
+            (np.s_[:, :-1], np.s_[:, 1:]),
+            (np.s_[:-1, :], np.s_[1:, :]),
+            (np.s_[:, 1:], np.s_[:, :-1]),
+        )
+        for side, (here, there) in enumerate(shifts):
+            neighbourExists[side][here] = True
+            neighbourFixed[side][here] = fixed[there]
+            neighbourFacing[side][here] = (masks[there] & FACING_BITS[side]) != 0
+
+        openEnds = 0
+        mismatches = 0
+        for side in range(4):
+            opens = fixed & ((masks & SIDE_BITS[side]) != 0)
+            openEnds += np.count_nonzero(opens & neighbourExists[side] & ~neighbourFixed[side])
+            # Cada ligação desencontrada entre duas peças fixas conta uma vez
+            # (do lado da peça aberta)
+            mismatches += np.count_nonzero(opens & ~neighbourExists[side])
+            mismatches += np.count_nonzero(opens & neighbourFixed[side] & ~neighbourFacing[side])
+
+        return int(np.count_nonzero(~fixed)) + int(openEnds) + MISMATCH_PENALTY * int(mismatches)
+
+    # Starts at the initial piece and goes through the paths of the tubes, only
+    # returns true if all pieces have been traversed and all connections are correct.
+    def verifySolution(self):
+        """Verifica de raiz (sem usar o ConnectivityTracker) se as peças
+        formam uma única rede sem pontas soltas."""
+        totalPieces = self.rows * self.cols
+        visited = bytearray(totalPieces)
+        stack = [0]
+        countPieces = 0
 
-        if (comparingPipe == None):
-            return False
-        
-        direction_connections = {
-            'C': ['FB', 'BB', 'BE', 'BD', 'VB', 'VE', 'LV'],
-            'B': ['FC', 'BC', 'BE', 'BD', 'VC', 'VD', 'LV'],
-            'E': ['FD', 'BC', 'BB', 'BD', 'VB', 'VD', 'LH'],
-            'D': ['FE', 'BC', 'BB', 'BE', 'VC', 'VE', 'LH']
-        }
-        
-        connections = {
-            'FC': {'C': direction_connections['C']},
-            'FB': {'B': direction_connections['B']},
-            'FE': {'E': direction_connections['E']},
-            'FD': {'D': direction_connections['D']},
-            'BC': {'C': direction_connections['C'], 'E': direction_connections['E'], 'D': direction_connections['D']},
-            'BB': {'B': direction_connections['B'], 'E': direction_connections['E'], 'D': direction_connections['D']},
-            'BE': {'E': direction_connections['E'], 'C': direction_connections['C'], 'B': direction_connections['B']},
-            'BD': {'C': direction_connections['C'], 'D': direction_connections['D'], 'B': direction_connections['B']},
-            'VC': {'E': direction_connections['E'], 'C': direction_connections['C']},
-            'VB': {'D': direction_connections['D'], 'B': direction_connections['B']},
-            'VE': {'E': direction_connections['E'], 'B': direction_connections['B']},
-            'VD': {'D': direction_connections['D'], 'C': direction_connections['C']},
-            'LH': {'E': direction_connections['E'], 'D': direction_connections['D']},
-            'LV': {'C': direction_connections['C'], 'B': direction_connections['B']}
-        }
-
-        # check if the position of the second pipe is compatible with the first pipe
-        if position not in connections[mainTube]:
-            return False
-        
-        # check if the comparing pipe is compatible with the first pipe at the specified position
-        if comparingPipe not in connections[mainTube][position]:
-            return False
-        
-        return True
-
-    def get_upperValue(self, row: int, col: int):
-        return [row - 1, col, 'C']
-    
-    def get_lowerValue(self, row: int, col: int):
-        return [row + 1, col, 'B']
-    
-    def get_rightValue(self, row: int, col: int):
-        return [row, col + 1, 'D']
-    
-    def get_leftValue(self, row: int, col: int):
-        return [row, col - 1, 'E']
-    
-    def getAdjacentPipes(self, row: int, col: int):
-        piece = self.get_value(row, col)
-        first_letter = piece[0]
-        second_letter = piece[1]
-
-        if first_letter == "F":
-            if second_letter == "C":
-                return [self.get_upperValue(row, col), ]
-            elif second_letter == "B":
-                return [self.get_lowerValue(row, col), ]
-            elif second_letter == "E":
-                return [self.get_leftValue(row, col), ]
-            elif second_letter == "D":
-                return [self.get_rightValue(row, col), ]
-        elif first_letter == "B":
-            if second_letter == "C":
-                return [self.get_leftValue(row, col), self.get_upperValue(row, col), self.get_rightValue(row, col)]
-            elif second_letter == "B":
-                return [self.get_leftValue(row, col), self.get_lowerValue(row, col), self.get_rightValue(row, col)]
-            elif second_letter == "E":
-                return [self.get_upperValue(row, col), self.get_leftValue(row, col), self.get_lowerValue(row, col)]
-            elif second_letter == "D":
-                return [self.get_upperValue(row, col), self.get_rightValue(row, col), self.get_lowerValue(row, col)]
-        elif first_letter == "V":
-            if second_letter == "C":
-                return [self.get_leftValue(row, col), self.get_upperValue(row, col)]
-            elif second_letter == "B":
-                return [self.get_lowerValue(row, col), self.get_rightValue(row, col)]
-            elif second_letter == "E":
-                return [self.get_leftValue(row, col), self.get_lowerValue(row, col)]
-            elif second_letter == "D":
-                return [self.get_upperValue(row, col), self.get_rightValue(row, col)]
-        elif first_letter == "L":
-            if second_letter == "H":
-                return [self.get_leftValue(row, col), self.get_rightValue(row, col)]
-            elif second_letter == "V":
-                return [self.get_upperValue(row, col), self.get_lowerValue(row, col)]
-            
-    def getSurroundingCoords(self, row, col):
-        return [(row - 1, col, 'C'), (row, col + 1, 'D'), (row + 1, col, 'B'), (row, col - 1, 'E')]
+        while(stack != []):
+            piece = stack.pop()
+
+            if (not visited[piece]):
+                visited[piece] = True
+                countPieces += 1
+
+                for adjacent, side in self.getAdjacentPipes(piece):
+                    # adds the pipes do the stack do continue visiting pipes
+                    if (self.compatiblePipes(piece, adjacent, side)):
+                        stack.append(adjacent)
+                    # found incompatible pipes, end
+                    else:
+                        return False
+
+        # verifies if every pipe was visited, if not it means that there
+        # are two or more different pipe structures.
+        return totalPieces == countPieces
+
+    def applySolution(self, cells):
+        """Devolve uma cópia do tabuleiro com as peças nas orientações dos
+        códigos cells (um por célula, por linhas), ou None se algum código
+        não for uma rotação da peça da mesma célula ou se as peças não
+        formarem uma só rede."""
+        cells = bytes(cells)
+        if len(cells) != self.rows * self.cols:
+            return None
+        if not (np.frombuffer(cells, dtype=np.uint8) >> 4 == np.frombuffer(self.cells, dtype=np.uint8) >> 4).all():
+            return None
+        solved = self.copy()
+        for index, code in enumerate(cells):
+            if not solved.tracker.fixed[index]:
+                solved.fixCell(index, CODE_ORIENTATION[code])
+        if not solved.verifySolution():
+            return None
+        return solved
+
+    def feasibilityReport(self, limit=5):
+        """Análise rápida, antes da procura, de condições necessárias para o
+        tabuleiro ter solução. Devolve a lista das razões pelas quais não
+        tem (vazia se nenhuma das verificações falhar), com no máximo limit
+        exemplos de cada problema encontrado nas células."""
+        rows, cols = self.rows, self.cols
+        size = rows * cols
+        types = np.frombuffer(self.cells, dtype=np.uint8).reshape(rows, cols) >> 4
+        degrees = np.array(PIECE_DEGREE, dtype=np.int64)[types]
+        reasons = []
+
+        # Cada ligação junta duas pontas, e são precisas pelo menos size - 1
+        # ligações para pôr as peças todas numa única rede (exatamente essas
+        # se a solução tiver de ser uma árvore)
+        total = int(degrees.sum())
+        if total % 2:
+            reasons.append(f"a soma das pontas das peças ({total}) é ímpar")
+        elif total < 2 * (size - 1):
+            reasons.append(f"as peças só fazem {total // 2} ligações, menos das {size - 1} "
+                           f"necessárias para ligar {size} peças")
+        elif not self.tracker.allowCycles and total != 2 * (size - 1):
+            reasons.append(f"as peças fazem {total // 2} ligações, mas uma árvore com "
+                           f"{size} peças tem {size - 1}")
+
+        # Numa grelha, cada ligação junta uma casa "preta" ((linha + coluna)
+        # par) a uma "branca", logo as pontas das duas cores são iguais
+        black = (np.add.outer(np.arange(rows), np.arange(cols)) % 2) == 0
+        blackEnds = int(degrees[black].sum())
+        whiteEnds = total - blackEnds
+        if total % 2 == 0 and blackEnds != whiteEnds:
+            reasons.append(f"as casas de linha + coluna par têm {blackEnds} pontas e as "
+                           f"restantes {whiteEnds}, mas cada ligação junta uma de cada")
+
+        # Peças que não cabem na sua posição sem apontar para fora
+        borders = np.frombuffer(self.borders, dtype=np.uint8).reshape(rows, cols)
+        fitting = FITTING_DOMAIN_NP[(types.astype(np.intp) << 8) | borders]
+        misfits = np.argwhere(fitting == 0)
+        if len(misfits):
+            where = ", ".join(f"{PIECE_TYPES[types[row, col]]} em ({row}, {col})"
+                              for row, col in misfits[:limit].tolist())
+            reasons.append(f"{len(misfits)} peças não cabem na borda do tabuleiro: {where}")
+
+        # Uma peça F cujos lados possíveis (dentro do tabuleiro) dão todos
+        # para outras peças F tem de se ligar a uma delas, e as duas ficam
+        # numa rede isolada (o domínio de uma peça F é a própria máscara dos
+        # lados que pode abrir)
+        if size > 2:
+            isF = types == 0
+            fSides = np.zeros((rows, cols), dtype=np.uint8)
+            fSides[1:, :] |= np.where(isF[:-1, :], SIDE_BITS[0], 0).astype(np.uint8)
+            fSides[:, :-1] |= np.where(isF[:, 1:], SIDE_BITS[1], 0).astype(np.uint8)
+            fSides[:-1, :] |= np.where(isF[1:, :], SIDE_BITS[2], 0).astype(np.uint8)
+            fSides[:, 1:] |= np.where(isF[:, :-1], SIDE_BITS[3], 0).astype(np.uint8)
+            trapped = np.argwhere(isF & (fitting != 0) & ((fitting & ~fSides) == 0))
+            if len(trapped):
+                where = ", ".join(f"({row}, {col})" for row, col in trapped[:limit].tolist())
+                reasons.append(f"{len(trapped)} peças F só se podem ligar a outras peças F, "
+                               f"ficando isoladas: {where}")
+
+        return reasons
 
     @staticmethod
     def parse_instance():
@@ -149,521 +872,2061 @@ class Board:
             > from sys import stdin
             > line = stdin.readline().split()
         """
-        cells = [line.strip().split() for line in sys.stdin]
-        cells_np = np.array(cells)
-        board = Board(cells_np)
-        board.board_first_approach()
-        return board
-    
-    def __str__(self):
-        """Devolve uma representação do tabuleiro em forma de string."""
-        result = ""
-        numRows = self.rows
-        numCols = self.cols
-
-        for i in range(numRows):
-            for j in range(numCols):
-                if(j == (numCols-1)):
-                    result += self.cells[i][j]
-                else:
-                    result += self.cells[i][j] + "\t"
-            if(i == (numRows-1)):
-                return result
-            else:
-                result += '\n'
-    
-    def verifyBorder(self, row, col):
-
-        board = self
+        return Board.parse_bytes(sys.stdin.buffer.read())
 
-        piece = board.get_value(row, col)
-        board_rows = board.rows
-        board_columns = board.cols
-
-        if piece[0] == 'B':
-
-            #Peca B na linha superior (sem ser nos cantos)
-            if row == 0:
-                board.cells[row][col] = 'BB'
-                board.rotated[row][col] = True
-            #Peca B na linha inferiorc (sem ser nos cantos)
-            elif row == board_rows - 1:
-                board.cells[row][col] = 'BC'
-                board.rotated[row][col] = True
-            #Peca B na coluna esquerda (sem ser nos cantos)
-            elif col == 0:
-                board.cells[row][col] = 'BD'
-                board.rotated[row][col] = True
-            #Peca B na coluna direita (sem ser nos cantos)
-            elif col == board_columns - 1:
-                board.cells[row][col] = 'BE'
-                board.rotated[row][col] = True
-
-        #Peca V
-        elif piece[0] == 'V':
-
-            #Peca V no canto superior esquerdo
-            if row == 0 and col == 0:
-                board.cells[row][col] = 'VB'
-                board.rotated[row][col] = True
-            #Peca V no canto superior direito
-            elif row == 0 and col == board_columns - 1:
-                board.cells[row][col] = 'VE'
-                board.rotated[row][col] = True
-            #Peca V no canto inferior esquerdo
-            elif row == board_rows - 1 and col == 0:
-                board.cells[row][col] = 'VD'
-                board.rotated[row][col] = True
-            #Peca V no canto inferior direito
-            elif row == board_rows - 1 and col == board_columns - 1:
-                board.cells[row][col] = 'VC'
-                board.rotated[row][col] = True
-                
-        #Peca L
-        elif piece[0] == 'L':
-
-            #Peca L na linha superior ou na linha inferior
-            if row == 0 or row == board_rows - 1:
-                board.cells[row][col] = 'LH'
-                board.rotated[row][col] = True
-            #Peca L na coluna esquerda ou na coluna direita
-            elif col == 0 or col == board_columns - 1:
-                board.cells[row][col] = 'LV'
-                board.rotated[row][col] = True
+    @staticmethod
+    def parse_lines(lines, prepare=True):
+        """Constrói o tabuleiro a partir das linhas de texto de uma instância
+        (ver parse_bytes)."""
+        return Board.parse_bytes('\n'.join(lines).encode(), prepare)
 
-        return
-    
-    def board_first_approach(self):
-    
-        board = self
-        board_rows = board.rows
-        board_columns = board.cols
+    @staticmethod
+    def parse_bytes(data, prepare=True):
+        """Constrói o tabuleiro a partir do texto de uma instância, lido de
+        uma vez como bytes. As peças são convertidas para a representação
+        compacta com a tabela TEXT_CODE, com operações numpy sobre o texto
+        todo, sem criar uma string por peça. As linhas em branco são
+        ignoradas. Com prepare a False, as peças ficam como foram lidas,
+        sem inicializar os domínios.
+
+        Lança ValueError se houver uma peça desconhecida, se as linhas não
+        tiverem todas o mesmo número de peças ou se não houver peças."""
+        text = np.frombuffer(data, dtype=np.uint8)
+        solid = TEXT_SPACE_NP[text] == 0
+        if not solid.any():
+            raise ValueError("tabuleiro vazio")
+        # Início de cada peça, e caracteres que continuam a peça anterior
+        starts = solid.copy()
+        starts[1:] &= ~solid[:-1]
+        follows = solid
+        follows[1:] &= ~starts[1:]
+        follows[0] = False
+        # Cada peça tem exatamente dois caracteres: nenhum caráter continua
+        # outro que já continuava, e há tantas continuações como peças
+        if (follows[1:] & follows[:-1]).any() or np.count_nonzero(follows) != np.count_nonzero(starts):
+            Board.raiseParseError(data)
+        codes = TEXT_CODE_NP[(text[starts].astype(np.uint16) << 8) | text[1:][starts[:-1]]]
+        if (codes == 0xFF).any():
+            Board.raiseParseError(data)
+
+        # Número de peças de cada linha (as linhas em branco não contam)
+        lineBreaks = [0] + (np.flatnonzero(text == ord('\n')) + 1).tolist() + [text.size]
+        rowLengths = np.array([np.count_nonzero(starts[begin:end])
+                               for begin, end in zip(lineBreaks, lineBreaks[1:])])
+        rowLines = np.flatnonzero(rowLengths)
+        rowLengths = rowLengths[rowLines]
+        cols = int(rowLengths[0])
+        wrong = np.flatnonzero(rowLengths != cols)
+        if wrong.size:
+            raise ValueError(f"a linha {rowLines[wrong[0]] + 1} tem {rowLengths[wrong[0]]} peças "
+                             f"em vez de {cols}")
+
+        board = Board(bytearray(codes), rowLengths.size, cols)
+        if prepare:
+            board.initDomains()
+        return board
 
+    @staticmethod
+    def raiseParseError(data):
+        """Procura, peça a peça, a primeira peça inválida do texto e lança o
+        ValueError correspondente (só é usado quando o texto tem erros)."""
+        for number, line in enumerate(bytes(data).decode(errors='replace').splitlines(), 1):
+            for piece in line.split():
+                if piece not in PIECE_CODES:
+                    raise ValueError(f"peça inválida {piece!r} na linha {number}")
+        raise ValueError("texto do tabuleiro inválido")
 
-        firstRow = 0
-        lastRow = board_rows - 1
-        
-        for i in range(board_columns):
-            board.verifyBorder(firstRow, i)
-            board.verifyBorder(lastRow, i)
+    @staticmethod
+    def load_binary(path, prepare=True):
+        """Lê um tabuleiro no formato binário (ver BINARY_HEADER). O ficheiro
+        é mapeado em memória em modo cópia-na-escrita e as células do
+        tabuleiro são uma vista sobre esse mapa, sem as copiar; as
+        alterações feitas pela procura não chegam ao ficheiro. prepare tem
+        o mesmo significado que em parse_lines."""
+        with open(path, 'rb') as instance:
+            mapped = mmap.mmap(instance.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(mapped) < BINARY_HEADER.size:
+            raise ValueError(f"{path}: ficheiro binário sem cabeçalho")
+        magic, version, rows, cols = BINARY_HEADER.unpack_from(mapped)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f"{path}: não é um tabuleiro binário (versão {BINARY_VERSION})")
+        if rows == 0 or cols == 0 or len(mapped) != BINARY_HEADER.size + rows * cols:
+            raise ValueError(f"{path}: dimensões {rows}x{cols} não batem com o tamanho do ficheiro")
+        cells = memoryview(mapped)[BINARY_HEADER.size:]
+        if not VALID_CODE_NP[np.frombuffer(cells, dtype=np.uint8)].all():
+            raise ValueError(f"{path}: código de peça inválido")
+        board = Board(cells, rows, cols)
+        if prepare:
+            board.initDomains()
+        return board
 
-        firstCol = 0
-        lastCol = board_columns - 1
+    def write_binary(self, stream):
+        """Escreve o tabuleiro no formato binário no stream (aberto em modo
+        binário), diretamente a partir das células."""
+        stream.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.rows, self.cols))
+        stream.write(self.cells)
 
-        for i in range(board_rows):
-            board.verifyBorder(i, firstCol)
-            board.verifyBorder(i, lastCol)
+    def __getstate__(self):
+        # As células podem ser uma vista de um ficheiro mapeado em memória,
+        # que não pode ser enviada para outro processo
+        state = dict(self.__dict__)
+        state['cells'] = bytearray(self.cells)
+        return state
 
+    def __str__(self):
+        """Devolve uma representação do tabuleiro em forma de string."""
+        return b''.join(self.textChunks()).decode()[:-1]
+
+    def textChunks(self, chunkSize=1 << 20):
+        """Gera o texto do tabuleiro (peças separadas por tabs e cada linha
+        terminada por um fim de linha) em blocos de bytes de cerca de
+        chunkSize bytes, com linhas inteiras. Cada bloco é construído de uma
+        vez com a tabela PIECE_TEXT."""
+        cells = self.cellsArray()
+        rowsPerChunk = max(1, chunkSize // (3 * self.cols))
+        for start in range(0, self.rows, rowsPerChunk):
+            block = PIECE_TEXT_NP[cells[start:start + rowsPerChunk]]
+            block[:, -1, 2] = ord('\n')
+            yield block.tobytes()
+
+    def write(self, stream):
+        """Escreve o texto do tabuleiro no stream (aberto em modo binário)
+        bloco a bloco, sem o construir todo em memória."""
+        for chunk in self.textChunks():
+            stream.write(chunk)
+
+    def initDomains(self):
+        """Inicializa o domínio de cada célula com as orientações em que a
+        peça não aponta para fora do tabuleiro. As peças da borda que só têm
+        uma orientação possível ficam logo fixas."""
+        size = self.rows * self.cols
+        cells = np.frombuffer(self.cells, dtype=np.uint8)
+        types = cells >> 4
+        domains = FITTING_DOMAIN_NP[(types.astype(np.intp) << 8) | np.frombuffer(self.borders, dtype=np.uint8)]
+        self.domains = bytearray(domains.tobytes())
+        fixed = np.flatnonzero(DOMAIN_SIZE_NP[domains] == 1)
+        cells[fixed] = SINGLE_CODE_NP[(types[fixed] << 4) | domains[fixed]]
+
+        for index in fixed.tolist():
+            if not self.tracker.fix(index, self.cells, self.neighbours):
+                self.cutBranch = True
+
+        # Na primeira propagação todas as células têm de ser revistas (num
+        # array de inteiros de 32 bits, para não criar um int por célula)
+        self.pending = index_array(size)
         return
 
-    def inferencedPossibleRotations(self, row, col):
-
-        board = self
-
-        targetingUs = {
-            'C': ['FB', 'BB', 'BE', 'BD', 'VB', 'VE', 'LV'],
-            'B': ['FC', 'BC', 'BE', 'BD', 'VC', 'VD', 'LV'],
-            'E': ['FD', 'BC', 'BB', 'BD', 'VB', 'VD', 'LH'],
-            'D': ['FE', 'BC', 'BB', 'BE', 'VC', 'VE', 'LH']
-        }
-
-        connectsWithPosition = {
-            'FC': ['C'],
-            'FB': ['B'],
-            'FE': ['E'],
-            'FD': ['D'],
-
-            'BC': ['E', 'C', 'D'],
-            'BB': ['E', 'B', 'D'],
-            'BE': ['E', 'C', 'B'],
-            'BD': ['C', 'D', 'B'],
-
-            'VC': ['E', 'C'],
-            'VB': ['B', 'D'],
-            'VE': ['E', 'B'],
-            'VD': ['C', 'D'],
-
-            'LH': ['E', 'D'],
-            'LV': ['C', 'B']
-        }
-
-
-        hasToConnect = []
-        doesntHaveToConnect = []
-        res = []
-
-        # Pega nas coordenadas das peças adjacentes
-        adjacentCoords = board.getSurroundingCoords(row, col)
-        for each in adjacentCoords:
-
-            # Se está na board
-            if(board.isOnBoard(each[0], each[1])):
-
-                # Se foi rodada (é como se estivesse no sitio certo, pode não estar)
-                if(board.rotated[each[0], each[1]]):
-                    # Se a peça está a apontar para nós, temos de apontar para ela, logo adiciona na hasToConnect
-                    if (board.get_value(each[0], each[1]) in targetingUs[each[2]]):
-
-                        hasToConnect += each[2]
-
-                    # Caso não esteja a apontar para nós mas esteja rodada, não podemos apontar para ela
-                    else:
-                        doesntHaveToConnect += each[2]
+    def setDomain(self, index, domain):
+        """Reduz o domínio da célula em index, rodando a peça para a sua
+        orientação quando fica fixa."""
+        if self.trail is not None:
+            self.trail.append((index, self.domains[index], self.cells[index]))
+        if self.buckets is not None:
+            self.moveBucket(index, self.domains[index], domain)
+        if self.zobrist is not None:
+            self.hash ^= self.zobristKey(index, self.domains[index] ^ domain)
+        self.domains[index] = domain
+        if DOMAIN_SIZE[domain] == 1:
+            self.cells[index] = ROTATION_TABLE[self.cells[index]][DOMAIN_SINGLE[domain]]
+            if not self.tracker.fixed[index] and not self.tracker.fix(index, self.cells, self.neighbours):
+                self.cutBranch = True
+        self.pending.append(index)
+
+    def fixCell(self, index, orientation):
+        """Fixa a peça em index na orientação dada."""
+        self.setDomain(index, 1 << orientation)
+
+    def checkpoint(self):
+        """Marca o ponto do registo de alterações para onde undo volta."""
+        return (len(self.trail), self.tracker.checkpoint())
+
+    def undo(self, checkpoint):
+        """Desfaz todas as alterações feitas depois do checkpoint."""
+        checkpoint, trackerCheckpoint = checkpoint
+        self.tracker.undo(trackerCheckpoint)
+        trail = self.trail
+        domains = self.domains
+        cells = self.cells
+        buckets = self.buckets
+        zobrist = self.zobrist
+        zobristKey = self.zobristKey
+        while len(trail) > checkpoint:
+            index, domain, cell = trail.pop()
+            if buckets is not None:
+                self.moveBucket(index, domains[index], domain)
+            if zobrist is not None:
+                self.hash ^= zobristKey(index, domains[index] ^ domain)
+            domains[index] = domain
+            cells[index] = cell
+        self.pending = []
+        self.cutBranch = False
 
-            # Se não estiver na board, a peça não pode conectar com essa posição
+    def reviseDomain(self, index):
+        """Devolve o domínio da célula em index restringido pelos domínios
+        das peças vizinhas e pela borda do tabuleiro."""
+
+        cells = self.cells
+        domains = self.domains
+
+        # Lados para onde a peça tem de apontar (todas as orientações do
+        # vizinho apontam para nós) e lados para onde não pode apontar
+        # (nenhuma orientação do vizinho aponta para nós, ou fora do tabuleiro)
+        required = 0
+        forbidden = self.borders[index]
+        adjacent = self.neighbours[index]
+        for side in range(4):
+            neighbour = adjacent[side]
+            if neighbour >= 0:
+                key = ((cells[neighbour] >> 4) << 4) | domains[neighbour]
+                if DOMAIN_MUST_OPEN[key] & FACING_BITS[side]:
+                    required |= SIDE_BITS[side]
+                elif not DOMAIN_MAY_OPEN[key] & FACING_BITS[side]:
+                    forbidden |= SIDE_BITS[side]
+
+        return domains[index] & FITTING_DOMAIN[((cells[index] >> 4) << 8) | (required << 4) | forbidden]
+
+    def buildBuckets(self):
+        """Constrói o índice das células não fixas para a política 'mrv'.
+        A célula em index fica no balde DOMAIN_SIZE * 5 + (4 - vizinhas fixas),
+        em que os lados para fora do tabuleiro contam como vizinhas fixas."""
+        size = self.rows * self.cols
+        domains = self.domains
+        neighbours = self.neighbours
+        self.fixedNeighbours = bytearray(size)
+        for index in range(size):
+            count = 0
+            for neighbour in neighbours[index]:
+                if neighbour < 0 or DOMAIN_SIZE[domains[neighbour]] == 1:
+                    count += 1
+            self.fixedNeighbours[index] = count
+        self.buckets = [{} for _ in range(25)]
+        for index in range(size):
+            domainSize = DOMAIN_SIZE[domains[index]]
+            if domainSize > 1:
+                self.buckets[domainSize * 5 + 4 - self.fixedNeighbours[index]][index] = None
+
+    def moveBucket(self, index, oldDomain, newDomain):
+        """Atualiza o índice da política 'mrv' quando o domínio da célula em
+        index passa de oldDomain para newDomain (chamado antes de o alterar)."""
+        buckets = self.buckets
+        fixedNeighbours = self.fixedNeighbours
+        oldSize = DOMAIN_SIZE[oldDomain]
+        newSize = DOMAIN_SIZE[newDomain]
+        if oldSize > 1:
+            buckets[oldSize * 5 + 4 - fixedNeighbours[index]].pop(index, None)
+        if newSize > 1:
+            buckets[newSize * 5 + 4 - fixedNeighbours[index]][index] = None
+
+        # A célula passou a estar fixa (ou deixou de estar): as vizinhas não
+        # fixas mudam de balde
+        if (oldSize == 1) == (newSize == 1):
+            return
+        delta = 1 if newSize == 1 else -1
+        domains = self.domains
+        for neighbour in self.neighbours[index]:
+            if neighbour < 0:
+                continue
+            neighbourSize = DOMAIN_SIZE[domains[neighbour]]
+            if neighbourSize > 1:
+                buckets[neighbourSize * 5 + 4 - fixedNeighbours[neighbour]].pop(neighbour, None)
+                fixedNeighbours[neighbour] += delta
+                buckets[neighbourSize * 5 + 4 - fixedNeighbours[neighbour]][neighbour] = None
             else:
-                doesntHaveToConnect += each[2]
-
-        # Depois de ter a lista de para onde tem de apontar e para onde não tem,
-        # ver se alguma rotação da peça se encaixa nessas restrições
-        possibleRotations = board.possibleRotations(row, col)
-
-        # Para cada rotação verifica as restrições
-        for each2 in possibleRotations:
-
-            # Pega na peça
-            piece = board.applyRotaion(each2[0], each2[1], each2[2])
-            connectsWith = connectsWithPosition[piece]
-            acceptablePiece = True
-            for position in hasToConnect:
-                if(position not in connectsWith):
-                    acceptablePiece = False
-            for position in doesntHaveToConnect:
-                if(position in connectsWith):
-                    acceptablePiece = False
-            if(acceptablePiece):
-                res.append((each2[0], each2[1], each2[2]))
-            
-        return res
-            
+                fixedNeighbours[neighbour] += delta
+
+    def selectBranchCell(self, start=0):
+        """Devolve a célula onde ramificar segundo self.branching, ou -1 se
+        todas as células estiverem fixas. Na política 'row-major', start é
+        a primeira célula que pode não estar fixa."""
+        region = self.region
+        if self.branching == 'mrv':
+            if self.buckets is None:
+                self.buildBuckets()
+            # Dentro de cada balde escolhe a célula que lá entrou mais
+            # recentemente, que está junto das últimas alterações
+            for bucket in self.buckets:
+                if region is None:
+                    if bucket:
+                        return next(reversed(bucket))
+                    continue
+                for index in reversed(bucket):
+                    if region[index]:
+                        return index
+            return -1
+
+        domains = self.domains
+        for index in range(start, self.rows * self.cols):
+            if DOMAIN_SIZE[domains[index]] > 1 and (region is None or region[index]):
+                return index
+        return -1
+
+    def findRegions(self):
+        """Agrupa as células não fixas em regiões ligadas entre si só por
+        células não fixas. Regiões diferentes estão separadas por peças
+        fixas, logo as restrições locais de uma não dependem das outras; só
+        a conectividade global as liga. Devolve uma lista de listas de
+        índices, cada uma por ordem crescente."""
+        domains = self.domains
+        neighbours = self.neighbours
+        seen = bytearray(self.rows * self.cols)
+        regions = []
+        for origin in range(self.rows * self.cols):
+            if seen[origin] or DOMAIN_SIZE[domains[origin]] == 1:
+                continue
+            seen[origin] = True
+            region = [origin]
+            stack = [origin]
+            while stack:
+                index = stack.pop()
+                for neighbour in neighbours[index]:
+                    if neighbour >= 0 and not seen[neighbour] and DOMAIN_SIZE[domains[neighbour]] > 1:
+                        seen[neighbour] = True
+                        region.append(neighbour)
+                        stack.append(neighbour)
+            region.sort()
+            regions.append(region)
+        return regions
+
+    def branchOrientations(self, index):
+        """Orientações do domínio da célula em index pela ordem em que devem
+        ser experimentadas. Na política 'mrv' vêm primeiro as que retiram
+        menos orientações aos domínios das vizinhas não fixas."""
+        cells = self.cells
+        domains = self.domains
+        pieceType = cells[index] >> 4
+        orientations = DOMAIN_ORIENTATIONS[(pieceType << 4) | domains[index]]
+        if self.branching != 'mrv':
+            return orientations
+
+        removed = {}
+        adjacent = self.neighbours[index]
+        for orientation in orientations:
+            mask = PIECE_MASKS[pieceType][orientation]
+            count = 0
+            for side in range(4):
+                neighbour = adjacent[side]
+                if neighbour < 0 or DOMAIN_SIZE[domains[neighbour]] == 1:
+                    continue
+                # A vizinha tem de apontar para nós sse esta orientação aponta para ela
+                if mask & SIDE_BITS[side]:
+                    fitting = FITTING_DOMAIN[((cells[neighbour] >> 4) << 8) | (FACING_BITS[side] << 4)]
+                else:
+                    fitting = FITTING_DOMAIN[((cells[neighbour] >> 4) << 8) | FACING_BITS[side]]
+                count += DOMAIN_SIZE[domains[neighbour]] - DOMAIN_SIZE[domains[neighbour] & fitting]
+            removed[orientation] = count
+        return sorted(orientations, key=removed.__getitem__)
+
     def testInference(self):
+        """Propaga as restrições entre peças vizinhas com o motor escolhido
+        em self.propagation."""
+        while True:
+            if self.propagation == 'vectorized':
+                self.propagateVectorized()
+            else:
+                self.propagateWorklist()
+            # As ligações obrigatórias encontradas pela propagação global
+            # reduzem domínios, que têm de voltar a ser propagados localmente
+            if self.cutBranch or not self.globalConnectivity or not self.propagateConnectivity():
+                return
+
+    def propagateWorklist(self):
+        """Propaga as restrições entre peças vizinhas a partir das células
+        cujo domínio mudou (AC-3): só os vizinhos de uma célula cujo domínio
+        acabou de ser reduzido voltam a ser revistos. Se algum domínio ficar
+        vazio, marca o ramo para ser cortado."""
 
         board = self
-        board_columns = board.cols
-        board_rows = board.rows
-
-        targetingUs = {
-            'C': ['FB', 'BB', 'BE', 'BD', 'VB', 'VE', 'LV'],
-            'B': ['FC', 'BC', 'BE', 'BD', 'VC', 'VD', 'LV'],
-            'E': ['FD', 'BC', 'BB', 'BD', 'VB', 'VD', 'LH'],
-            'D': ['FE', 'BC', 'BB', 'BE', 'VC', 'VE', 'LH']
-        }
-
-        connectsWithPosition = {
-            'FC': ['C'],
-            'FB': ['B'],
-            'FE': ['E'],
-            'FD': ['D'],
-
-            'BC': ['E', 'C', 'D'],
-            'BB': ['E', 'B', 'D'],
-            'BE': ['E', 'C', 'B'],
-            'BD': ['C', 'D', 'B'],
-
-            'VC': ['E', 'C'],
-            'VB': ['B', 'D'],
-            'VE': ['E', 'B'],
-            'VD': ['C', 'D'],
-
-            'LH': ['E', 'D'],
-            'LV': ['C', 'B']
-        }
-
-
-        hasToConnect = []
-        doesntHaveToConnect = []
-        pieceCount = 0
-        changed = True
-        i = 0
-
-        while(changed):
-            changed = False
-            for row in range(board_rows):
-                for col in range(board_columns):
-
-                    # Verificar se está a false, caso esteja, ver se só tem 1 possibilidade de rotação
-                    if(not board.rotated[row][col]):
-
-                        # Pega nas coordenadas das peças adjacentes
-                        adjacentCoords = board.getSurroundingCoords(row, col)
-                        for each in adjacentCoords:
-
-                            # Se está na board
-                            if(board.isOnBoard(each[0], each[1])):
-
-                                # Se foi rodada (é como se estivesse no sitio certo, pode não estar)
-                                if(board.rotated[each[0], each[1]]):
-                                    # Se a peça está a apontar para nós, temos de apontar para ela, logo adiciona na hasToConnect
-                                    if (board.get_value(each[0], each[1]) in targetingUs[each[2]]):
-
-                                        hasToConnect += each[2]
-
-                                    # Caso não esteja a apontar para nós mas esteja rodada, não podemos apontar para ela
-                                    else:
-                                        doesntHaveToConnect += each[2]
-
-                            # Se não estiver na board, a peça não pode conectar com essa posição
-                            else:
-                                doesntHaveToConnect += each[2]
-
-                        # Depois de ter a lista de para onde tem de apontar e para onde não tem,
-                        # ver se alguma rotação da peça se encaixa nessas restrições
-                        possibleRotations = board.possibleRotations(row, col)
-
-                        # Para cada rotação verifica as restrições
-                        for each2 in possibleRotations:
-
-                            # Pega na peça
-                            piece = board.applyRotaion(each2[0], each2[1], each2[2])
-                            connectsWith = connectsWithPosition[piece]
-                            acceptablePiece = True
-                            for position in hasToConnect:
-                                if(position not in connectsWith):
-                                    acceptablePiece = False
-                            for position in doesntHaveToConnect:
-                                if(position in connectsWith):
-                                    acceptablePiece = False
-                            # Modificar este if para verificar se mais de uma peça dá fit-in
-                            # se sim não altera, caso seja 0, mata branch
-                            # em caso de ser igual a 1, altera
-                            if(acceptablePiece):
-                                rightPiece = piece
-                                pieceCount += 1
-                        if(pieceCount == 1):
-                            board.cells[row][col] = rightPiece
-                            board.rotated[row][col] = True
-                            changed = True
-                        elif(pieceCount == 0):
-                            board.cutBranch = True
-                            return
-                        pieceCount = 0
-                        hasToConnect = []
-                        doesntHaveToConnect = []
-                                
+        if board.cutBranch:
+            return
+        domains = board.domains
+        neighbours = board.neighbours
+        trail = board.trail
+        tracker = board.tracker
+        buckets = board.buckets
+
+        # Fila de células a rever, sem repetições
+        queued = bytearray(board.rows * board.cols)
+        queue = deque()
+        for index in board.pending:
+            for neighbour in neighbours[index]:
+                if neighbour >= 0 and not queued[neighbour]:
+                    queued[neighbour] = True
+                    queue.append(neighbour)
+        board.pending = []
+
+        while(queue):
+            index = queue.popleft()
+            queued[index] = False
+
+            domain = board.reviseDomain(index)
+            board.revisions += 1
+            if(domain != domains[index]):
+                # Se nenhuma orientação encaixa, mata o ramo
+                if(domain == 0):
+                    board.cutBranch = True
+                    board.pending = []
+                    return
+                if trail is not None:
+                    trail.append((index, domains[index], board.cells[index]))
+                if buckets is not None:
+                    board.moveBucket(index, domains[index], domain)
+                if board.zobrist is not None:
+                    board.hash ^= board.zobristKey(index, domains[index] ^ domain)
+                domains[index] = domain
+                if(DOMAIN_SIZE[domain] == 1):
+                    board.cells[index] = ROTATION_TABLE[board.cells[index]][DOMAIN_SINGLE[domain]]
+                    # A peça ficou fixa: fecha um ciclo ou isola uma componente?
+                    if not tracker.fix(index, board.cells, neighbours):
+                        board.cutBranch = True
+                        board.pending = []
+                        return
+                # O domínio mudou, logo os vizinhos têm de ser revistos
+                for neighbour in neighbours[index]:
+                    if neighbour >= 0 and not queued[neighbour]:
+                        queued[neighbour] = True
+                        queue.append(neighbour)
+
         return
 
-    def possibleRotations(self, row, column):
+    def propagateVectorized(self):
+        """Propaga as restrições em muitas células ao mesmo tempo: desloca
+        as máscaras de lados obrigatórios e possíveis de cada célula para as
+        quatro vizinhas e filtra os domínios de uma vez, repetindo até nada
+        mudar. Cada passagem só revê a janela retangular que envolve as
+        vizinhas das células alteradas (na primeira, as de self.pending),
+        alargada de uma célula para ler as máscaras das vizinhas. Se algum
+        domínio ficar vazio, marca o ramo para ser cortado."""
+
+        if not self.pending or self.cutBranch:
+            return
+        rows, cols = self.rows, self.cols
+        pending = np.asarray(self.pending, dtype=np.intp)
+        self.pending = []
+
+        cells = self.cellsArray()
+        domains = self.domainsArray()
+        borders = np.frombuffer(self.borders, dtype=np.uint8).reshape(rows, cols)
+        pendingRows, pendingCols = np.divmod(pending, cols)
+        top, bottom = int(pendingRows.min()), int(pendingRows.max()) + 1
+        left, right = int(pendingCols.min()), int(pendingCols.max()) + 1
+
+        while True:
+            # Janela a rever (vizinhas das células alteradas) e moldura com
+            # mais uma célula de cada lado, de onde vêm as máscaras
+            top, bottom = max(top - 1, 0), min(bottom + 1, rows)
+            left, right = max(left - 1, 0), min(right + 1, cols)
+            frameTop, frameBottom = max(top - 1, 0), min(bottom + 1, rows)
+            frameLeft, frameRight = max(left - 1, 0), min(right + 1, cols)
+            window = (slice(top - frameTop, bottom - frameTop), slice(left - frameLeft, right - frameLeft))
+
+            frameDomains = domains[frameTop:frameBottom, frameLeft:frameRight]
+            types = cells[frameTop:frameBottom, frameLeft:frameRight] >> 4
+            keys = (types << 4) | frameDomains
+            mustOpen = DOMAIN_MUST_OPEN_NP[keys]
+            mayOpen = DOMAIN_MAY_OPEN_NP[keys]
+
+            # Lado C da célula <-> lado B da vizinha de cima, lado D <-> lado E
+            # da vizinha da direita, lado B <-> lado C da vizinha de baixo e
+            # lado E <-> lado D da vizinha da esquerda
+            required = np.zeros_like(frameDomains)
+            required[1:, :] |= (mustOpen[:-1, :] >> 2) & 1
+            required[:, :-1] |= (mustOpen[:, 1:] >> 2) & 2
+            required[:-1, :] |= (mustOpen[1:, :] << 2) & 4
+            required[:, 1:] |= (mustOpen[:, :-1] << 2) & 8
+            allowed = np.zeros_like(frameDomains)
+            allowed[1:, :] |= (mayOpen[:-1, :] >> 2) & 1
+            allowed[:, :-1] |= (mayOpen[:, 1:] >> 2) & 2
+            allowed[:-1, :] |= (mayOpen[1:, :] << 2) & 4
+            allowed[:, 1:] |= (mayOpen[:, :-1] << 2) & 8
+
+            # Só as células da janela têm as quatro vizinhas dentro da moldura
+            oldDomains = frameDomains[window]
+            windowTypes = types[window]
+            forbidden = (~allowed[window] & 15) | borders[top:bottom, left:right]
+            fittingKeys = (windowTypes.astype(np.uint16) << 8) | (required[window].astype(np.uint16) << 4) | forbidden
+            newDomains = oldDomains & FITTING_DOMAIN_NP[fittingKeys]
+            self.revisions += newDomains.size
+
+            changed = newDomains != oldDomains
+            if not changed.any():
+                return
+            if not newDomains[changed].all():
+                self.cutBranch = True
+                return
+
+            changedRows, changedCols = np.nonzero(changed)
+            changedIndices = ((changedRows + top) * cols + changedCols + left).tolist()
+            before = oldDomains[changed]
+            after = newDomains[changed]
+            windowCells = cells[top:bottom, left:right]
+            if self.trail is not None:
+                self.trail.extend(zip(changedIndices, before.tolist(), windowCells[changed].tolist()))
+            if self.buckets is not None:
+                for index, oldDomain, newDomain in zip(changedIndices, before.tolist(), after.tolist()):
+                    self.moveBucket(index, oldDomain, newDomain)
+            if self.zobrist is not None:
+                indices = np.array(changedIndices, dtype=np.intp)
+                removed = before ^ after
+                for orientation in range(4):
+                    present = ((removed >> orientation) & 1).astype(bool)
+                    self.hash ^= int(np.bitwise_xor.reduce(self.zobrist[indices[present], orientation]))
+            oldDomains[changed] = after
+            fixed = changed & (DOMAIN_SIZE_NP[newDomains] == 1)
+            windowCells[fixed] = SINGLE_CODE_NP[(windowTypes[fixed] << 4) | newDomains[fixed]]
+            fixedRows, fixedCols = np.nonzero(fixed)
+            for index in ((fixedRows + top) * cols + fixedCols + left).tolist():
+                if not self.tracker.fix(index, self.cells, self.neighbours):
+                    self.cutBranch = True
+                    return
+
+            # A próxima passagem revê as vizinhas das células que mudaram
+            top, bottom = top + int(changedRows.min()), top + int(changedRows.max()) + 1
+            left, right = left + int(changedCols.min()), left + int(changedCols.max()) + 1
+
+    def propagateConnectivity(self):
+        """Propagação global sobre o grafo das ligações ainda possíveis, em
+        que cada componente de peças fixas (do ConnectivityTracker) é um só
+        nó, ligado às células ainda não fixas vizinhas. Se o grafo estiver
+        desconexo nenhuma solução é possível e o ramo é cortado. Caso
+        contrário, as pontes do grafo (algoritmo de Tarjan) são ligações que
+        todas as soluções usam, logo as duas peças de cada ponte têm de
+        apontar uma para a outra. Devolve True se algum domínio foi reduzido."""
+
+        cells = self.cells
+        domains = self.domains
+        neighbours = self.neighbours
+        tracker = self.tracker
+
+        unfixed = np.flatnonzero(DOMAIN_SIZE_NP[self.domainsArray().ravel()] > 1).tolist()
+        if not unfixed:
+            return False
 
-        board = self
-        piece = board.get_value(row, column)
-
-        board_rows = board.rows
-        board_columns = board.cols
-
-        actions_FBV = ('C','B','E','D')
-        actions_L = ('H','V')
-
-        actions_F_canto_superior_direito = ('B','E')
-        actions_F_canto_superior_esquerdo = ('B','D')
-        actions_F_canto_inferior_direito = ('C','E')
-        actions_F_canto_inferior_esquerdo = ('C','D')
-
-        actions_F_linha_superior = ('B','E','D')
-        actions_F_linha_inferior = ('C','E','D')
-        actions_F_coluna_esquerda = ('C','B','D')
-        actions_F_coluna_direita = ('C','B','E')
-
-        actions_V_primeira_linha = ('B','E')
-        actions_V_ultima_linha = ('C','D')
-        actions_V_primeira_coluna = ('B','D')
-        actions_V_ultima_coluna = ('C','E')
-        
-        actions = []
-
-        if ((row != 0 and row != board_rows-1) and (column != 0 and column != board_columns-1)):
-            if (piece[0] == 'L'):
-                for position in actions_L:
-                    actions.append((row,column,position),)
-            else:
-                for position in actions_FBV:
-                    actions.append((row,column,position),)
-
-        #Peca F
-        elif piece[0] == 'F':
-
-            #Peca F no canto superior esquerdo
-            if row == 0 and column == 0:
-                for position in actions_F_canto_superior_esquerdo:
-                    actions.append((row,column,position),)
-            #Peca F no canto superior direito
-            elif row == 0 and column == board_columns - 1:
-                for position in actions_F_canto_superior_direito:
-                    actions.append((row,column,position),)
-            #Peca F no canto inferior esquerdo
-            elif row == board_rows - 1 and column == 0:
-                for position in actions_F_canto_inferior_esquerdo:
-                    actions.append((row,column,position),)
-            #Peca F no canto inferior direito
-            elif row == board_rows - 1 and column == board_columns - 1:
-                for position in actions_F_canto_inferior_direito:
-                    actions.append((row,column,position),)
-
-            #Peca F na linha superior (sem ser nos cantos)
-            elif row == 0:
-                for position in actions_F_linha_superior:
-                    actions.append((row,column,position),)
-            #Peca F na linha inferior (sem ser nos cantos)
-            elif row == board_rows - 1:
-                for position in actions_F_linha_inferior:
-                    actions.append((row,column,position),)
-            #Peca F na coluna esquerda (sem ser nos cantos)
-            elif column == 0:
-                for position in actions_F_coluna_esquerda:
-                    actions.append((row,column,position),)
-            #Peca F na coluna direita (sem ser nos cantos)
-            elif column == board_columns - 1:
-                for position in actions_F_coluna_direita:
-                    actions.append((row,column,position),)
-
-        #Peca V
-        elif piece[0] == 'V':
-            
-            #Peca V na linha superior (sem ser nos cantos)
-            if row == 0:
-                for position in actions_V_primeira_linha:
-                    actions.append((row,column,position),)
-            #Peca V na linha inferior (sem ser nos cantos)
-            elif row == board_rows - 1:
-                for position in actions_V_ultima_linha:
-                    actions.append((row,column,position),)
-            #Peca V na coluna esquerda (sem ser nos cantos)
-            elif column == 0:
-                for position in actions_V_primeira_coluna:
-                    actions.append((row,column,position),)
-            #Peca V na coluna direita (sem ser nos cantos)
-            elif column == board_columns - 1:
-                for position in actions_V_ultima_coluna:
-                    actions.append((row,column,position),)
-            
-        return actions
-
-    def applyRotaion(self, row, column, rotation):
-        board = self
+        # Arestas (célula não fixa, lado) para vizinhas a que a ligação ainda
+        # é possível; as vizinhas fixas são substituídas pela raiz da sua
+        # componente. Pode haver várias arestas entre os mesmos dois nós.
+        adjacency = {index: [] for index in unfixed}
+        edges = []
+        for index in unfixed:
+            mayOpen = DOMAIN_MAY_OPEN[((cells[index] >> 4) << 4) | domains[index]]
+            adjacent = neighbours[index]
+            for side in range(4):
+                if not mayOpen & SIDE_BITS[side]:
+                    continue
+                neighbour = adjacent[side]
+                if neighbour < 0:
+                    continue
+                if DOMAIN_SIZE[domains[neighbour]] > 1:
+                    # Cada aresta entre duas células não fixas só é criada uma vez
+                    if neighbour < index:
+                        continue
+                    if not DOMAIN_MAY_OPEN[((cells[neighbour] >> 4) << 4) | domains[neighbour]] & FACING_BITS[side]:
+                        continue
+                    other = neighbour
+                else:
+                    if not cells[neighbour] & FACING_BITS[side]:
+                        continue
+                    other = tracker.find(neighbour)
+                    if other not in adjacency:
+                        adjacency[other] = []
+                edgeId = len(edges)
+                edges.append((index, side))
+                adjacency[index].append((other, edgeId))
+                adjacency[other].append((index, edgeId))
+
+        # Há componentes de peças fixas sem ligação possível às restantes
+        if len(adjacency) - len(unfixed) < tracker.components:
+            self.cutBranch = True
+            return False
 
-        piece = board.get_value(row, column)
+        # Procura em profundidade iterativa com tempos de descoberta (disc) e
+        # o menor tempo alcançável pela subárvore (low)
+        start = unfixed[0]
+        disc = {start: 0}
+        low = {start: 0}
+        timer = 1
+        bridges = []
+        # Cada entrada é [nó, aresta pela qual se chegou, iterador das arestas]
+        stack = [[start, -1, iter(adjacency[start])]]
+        while stack:
+            frame = stack[-1]
+            node = frame[0]
+            for other, edgeId in frame[2]:
+                if edgeId == frame[1]:
+                    continue
+                if other not in disc:
+                    disc[other] = low[other] = timer
+                    timer += 1
+                    stack.append([other, edgeId, iter(adjacency[other])])
+                    break
+                if disc[other] < low[node]:
+                    low[node] = disc[other]
+            else:
+                stack.pop()
+                if stack:
+                    parentNode = stack[-1][0]
+                    if low[node] < low[parentNode]:
+                        low[parentNode] = low[node]
+                    if low[node] > disc[parentNode]:
+                        bridges.append(edges[frame[1]])
+
+        # Há nós que não se conseguem ligar aos restantes
+        if timer < len(adjacency):
+            self.cutBranch = True
+            return False
 
-        firstLetter = piece[0]
-        newPiece = firstLetter + rotation
+        changed = False
+        for index, side in bridges:
+            for cell, cellSide in ((index, side), (neighbours[index][side], OPPOSITE_SIDE[side])):
+                key = ((cells[cell] >> 4) << 4) | domains[cell]
+                if DOMAIN_MUST_OPEN[key] & SIDE_BITS[cellSide]:
+                    continue
+                domain = domains[cell] & FITTING_DOMAIN[((cells[cell] >> 4) << 8) | (SIDE_BITS[cellSide] << 4)]
+                if domain == 0:
+                    self.cutBranch = True
+                    return False
+                self.setDomain(cell, domain)
+                changed = True
+                if self.cutBranch:
+                    return False
 
-        return newPiece
+        return changed
 
 
 class PipeMania(Problem):
-    def __init__(self, board: Board):
-        """O construtor especifica o estado inicial."""
+    def __init__(self, board: Board, sharedStates=False, checkHeuristic=False):
+        """O construtor especifica o estado inicial, já propagado. Com
+        sharedStates, os estados gerados guardam só um BoardSnapshot que
+        partilha os blocos sem alterações com o do pai (ver BoardSnapshot).
+        Com checkHeuristic, h compara o valor incremental da heurística com
+        o recalculado de raiz por Board.heuristicFull."""
         self.board = board
-        self.initial = PipeManiaState(board)
+        self.sharedStates = sharedStates
+        self.checkHeuristic = checkHeuristic
+        board.testInference()
+        self.initial = PipeManiaState(board, board.snapshot() if sharedStates else None)
+
+    def child(self, state: PipeManiaState, action):
+        """Cria o estado filho: fixa a peça da ação numa cópia do tabuleiro e
+        propaga logo, uma única vez. Devolve None se o ramo ficou cortado.
+        Depois disto o estado não volta a ser alterado."""
+        row, col, rotation = action
+        newBoard = state.board.copy()
+
+        if self.sharedStates and state.snapshot is not None:
+            # Regista as células alteradas, para o snapshot do filho só
+            # copiar os blocos que mudaram
+            newBoard.trail = []
+            newBoard.tracker.history = []
+            newBoard.fixCell(row * newBoard.cols + col, rotation)
+            newBoard.testInference()
+            if newBoard.cutBranch:
+                return None
+            changed = Board.recordedChanges(newBoard.trail, newBoard.tracker.history)
+            newBoard.trail = None
+            newBoard.tracker.history = None
+            return PipeManiaState(snapshot=newBoard.snapshot(state.snapshot, changed))
+
+        newBoard.fixCell(row * newBoard.cols + col, rotation)
+        newBoard.testInference()
+        if newBoard.cutBranch:
+            return None
+        return PipeManiaState(newBoard)
 
     def actions(self, state: PipeManiaState):
         """Retorna uma lista de ações que podem ser executadas a
-        partir do estado passado como argumento."""
+        partir do estado passado como argumento. Os filhos são criados aqui
+        e os que a propagação corta são descartados antes de chegarem à
+        fronteira; result devolve os restantes."""
+
+        if state.children is None:
+            state.children = {}
+            board = state.board
+            if board.cutBranch:
+                return []
+
+            # Ramifica numa célula que ainda não está fixa, escolhida segundo
+            # a política board.branching; se estão todas fixas, o estado já
+            # foi testado pelo goal_test
+            index = board.selectBranchCell()
+            if index >= 0:
+                row, col = divmod(index, board.cols)
+                for orientation in board.branchOrientations(index):
+                    action = (row, col, orientation)
+                    child = self.child(state, action)
+                    if child is not None:
+                        state.children[action] = child
+        return list(state.children)
 
-        board = state.board
-        board_cols = board.cols
-        board_rows = board.rows
-
-        board.testInference()
-        if (board.cutBranch):
-            return []
-        
-        rotated_pieces = state.board.rotated
-
-        row = 0
-        col = 0
-
-        while(rotated_pieces[row][col]):
-            col+=1
-            if col == board_cols:
-                col = 0
-                row+=1
-            if row == board_rows:
-                return [(0, 0, board.cells[0][0][1])]
-        
-        state.board.rotated[row][col] = True
-        return board.inferencedPossibleRotations(row, col)
-    
     def result(self, state: PipeManiaState, action):
         """Retorna o estado resultante de executar a 'action' sobre
         'state' passado como argumento. A ação a executar deve ser uma
         das presentes na lista obtida pela execução de
         self.actions(state)."""
 
-        newCells = np.copy(state.board.cells)
-        newRotated = np.copy(state.board.rotated)
+        if state.children is not None and action in state.children:
+            return state.children.pop(action)
+        return self.child(state, action)
 
-        row = action[0]
-        col = action[1]
-        rotation = action[2]
+    def goal_test(self, state: PipeManiaState):
+        """Retorna True se e só se o estado passado como argumento é
+        um estado objetivo. Deve verificar se todas as posições do tabuleiro
+        estão preenchidas de acordo com as regras do problema."""
+        # As ligações entre peças fixas são mantidas de forma incremental
+        return state.isComplete()
 
-        newBoard = Board(newCells)
-        newBoard.rotated = newRotated
+    def h(self, node: Node):
+        """Função heuristica utilizada para a procura A*."""
+        # O ConnectivityTracker do tabuleiro é copiado do pai e atualizado a
+        # cada peça fixada, logo o valor é incremental (ver heuristicFull)
+        value = node.state.heuristic()
+        if self.checkHeuristic:
+            full = node.state.board.heuristicFull()
+            if value != full:
+                raise AssertionError(f"incremental heuristic {value} != full recompute {full}")
+        return value
+
+def depth_first_trail_search(problem: PipeMania, region=None):
+    """Procura em profundidade que altera um único tabuleiro no próprio
+    sítio em vez de copiar o tabuleiro para cada filho. Cada alteração fica
+    no registo (trail) do tabuleiro e, ao retroceder, o tabuleiro é reposto
+    no checkpoint do ramo. Devolve o tabuleiro inicial resolvido, ou None.
+
+    Com region (lista de índices de células), só ramifica nessas células e
+    devolve o tabuleiro assim que ficam todas fixas sem cortar o ramo, sem
+    testar o objetivo (as restantes células podem não estar fixas)."""
+
+    board = problem.initial.board
+    board.trail = []
+    board.tracker.history = []
+    if region is not None:
+        board.region = bytearray(board.rows * board.cols)
+        for index in region:
+            board.region[index] = True
+
+    board.testInference()
+    if board.cutBranch:
+        board.trail = None
+        board.tracker.history = None
+        board.region = None
+        return None
+    root = board.checkpoint()
+
+    # Cada entrada da pilha é (checkpoint, célula, orientações, próxima orientação)
+    stack = []
+    start = 0
+    while True:
+        # Ramifica numa célula que ainda não está fixa; na política
+        # 'row-major' as anteriores a start estão todas fixas neste ramo
+        index = board.selectBranchCell(start)
+
+        if index < 0:
+            if region is not None or problem.goal_test(problem.initial):
+                board.trail = None
+                board.tracker.history = None
+                board.region = None
+                return board
+        else:
+            stack.append([board.checkpoint(), index, board.branchOrientations(index), 0])
+
+        # Experimenta a próxima orientação do ramo mais fundo, retrocedendo
+        # enquanto os ramos estiverem esgotados
+        while stack:
+            frame = stack[-1]
+            checkpoint, index, orientations, nextOrientation = frame
+            board.undo(checkpoint)
+            if nextOrientation == len(orientations):
+                stack.pop()
+                continue
+            frame[3] += 1
+            board.fixCell(index, orientations[nextOrientation])
+            board.testInference()
+            if not board.cutBranch:
+                start = index + 1
+                break
+        else:
+            board.undo(root)
+            board.trail = None
+            board.tracker.history = None
+            board.region = None
+            return None
+
+
+def solve_region(board: Board, region):
+    """Resolve só as células de region numa cópia do tabuleiro. Devolve a
+    orientação de cada célula da região, ou None se não houver nenhuma
+    forma de as fixar."""
+    solved = depth_first_trail_search(PipeMania(board.copy()), region)
+    if solved is None:
+        return None
+    return [DOMAIN_SINGLE[solved.domains[index]] for index in region]
+
+
+def region_search(problem: PipeMania, workers=1):
+    """Depois da propagação inicial, divide as células por fixar em regiões
+    separadas por peças fixas (ver Board.findRegions) e resolve cada uma à
+    parte, somando as procuras em vez de as multiplicar. Com workers > 1 as
+    regiões são resolvidas num conjunto de processos.
+
+    Uma região sem solução torna o tabuleiro impossível. Como a
+    conectividade global liga as regiões, as soluções juntas podem não
+    formar uma só componente: nesse caso volta à procura sobre o tabuleiro
+    inteiro. Devolve o tabuleiro inicial resolvido, ou None."""
+    board = problem.initial.board
+    board.testInference()
+    if board.cutBranch:
+        return None
+    regions = board.findRegions()
+    if len(regions) <= 1:
+        return depth_first_trail_search(problem)
 
-        newPiece = newBoard.applyRotaion(row, col, rotation)
-        newBoard.cells[row][col] = newPiece
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            solutions = list(executor.map(solve_region, [board] * len(regions), regions))
+    else:
+        solutions = [solve_region(board, region) for region in regions]
+    if any(solution is None for solution in solutions):
+        return None
 
-        newState = PipeManiaState(newBoard)
+    joint = board.copy()
+    for region, orientations in zip(regions, solutions):
+        for index, orientation in zip(region, orientations):
+            board.fixCell(index, orientation)
+    board.testInference()
+    if not board.cutBranch and problem.goal_test(problem.initial):
+        return board
+    return depth_first_trail_search(PipeMania(joint))
 
-        return newState
 
-    # Starts at the initial piece and goes through the paths of the tubes, only 
-    # returns true if all pieces have been traversed and all connections are correct.
-    def goal_test(self, state: PipeManiaState):
-        """Retorna True se e só se o estado passado como argumento é
-        um estado objetivo. Deve verificar se todas as posições do tabuleiro
-        estão preenchidas de acordo com as regras do problema."""
-        board = state.board
-        visited = [[False for _ in range(board.cols)] for _ in range(board.rows)]
-        stack = []
-        first_piece = [0, 0]
-        stack.append(first_piece)
+# Parâmetros do CDCLSolver: fator de decaimento da atividade das variáveis
+# (VSIDS) e número de conflitos da unidade da sequência de reinícios de Luby
+ACTIVITY_DECAY = 0.95
+RESTART_BASE = 100
 
-        totalPieces = board.rows * board.cols
-        countPieces = 0
 
-        stillCompatible = 1
-        while(stack != []):
-            piece = stack.pop()
-            piece_row = piece[0]
-            piece_col = piece[1]
-            piece_str = board.get_value(piece_row, piece_col)
+class CDCLSolver:
+    """Resolve um tabuleiro com aprendizagem de cláusulas (CDCL), sem
+    recorrer a um solver SAT externo. Há uma variável por (célula,
+    orientação ainda no domínio); o literal 2*v diz que a variável v é
+    verdadeira e 2*v+1 que é falsa. As cláusulas dizem que cada célula tem
+    exatamente uma orientação e que as ligações entre vizinhas batem certo;
+    são propagadas com dois literais vigiados por cláusula. Cada conflito
+    gera uma cláusula aprendida (1UIP) e um retrocesso não cronológico, e
+    as decisões seguem a atividade das variáveis (VSIDS).
 
-            if (not visited[piece_row][piece_col]):
-                visited[piece_row][piece_col] = True
-                countPieces += 1
-                # [row, col, position relative to the main piece]
-                adjacentPipesList = board.getAdjacentPipes(piece_row, piece_col)
-
-                # if all pipes are compatible at a certain moment
-                if (stillCompatible):
-                    for coord_sec_piece in adjacentPipesList:
-                        str_sec_piece = board.get_value(coord_sec_piece[0], coord_sec_piece[1])
-                        position = coord_sec_piece[2]
-                        # adds the pipes do the stack do continue visiting pipes
-                        if (board.compatiblePipes(piece_str, str_sec_piece, position)):
-                            stack += [[coord_sec_piece[0], coord_sec_piece[1]], ]
-
-                        # incompatible pipes
-                        else:
-                            stillCompatible = 0
-                # found incompatible pipes, end
+    A conectividade é verificada de forma preguiçosa: sempre que a
+    propagação estabiliza, as componentes das peças com orientação já
+    decidida que ficaram fechadas sem cobrir o tabuleiro (e os ciclos, se a
+    solução tiver de ser uma árvore) dão origem a uma cláusula de explicação
+    que proíbe aquela combinação de orientações."""
+
+    def __init__(self, board: Board):
+        self.board = board
+        size = board.rows * board.cols
+        cells = board.cells
+
+        # Variáveis de cada célula e (célula, orientação) de cada variável
+        self.cellVars = []
+        self.varCell = []
+        self.varOrientation = []
+        for index in range(size):
+            variables = []
+            for orientation in DOMAIN_ORIENTATIONS[((cells[index] >> 4) << 4) | board.domains[index]]:
+                variables.append((orientation, len(self.varCell)))
+                self.varCell.append(index)
+                self.varOrientation.append(orientation)
+            self.cellVars.append(variables)
+
+        numVars = len(self.varCell)
+        self.value = [-1] * numVars
+        self.level = [0] * numVars
+        self.reason = [-1] * numVars
+        self.activity = [0.0] * numVars
+        self.activityIncrement = 1.0
+        self.heap = [(0.0, var) for var in range(numVars)]
+        self.trail = []
+        self.trailLimits = []
+        self.propagateHead = 0
+        self.checkHead = 0
+        self.clauses = []
+        self.watches = [[] for _ in range(2 * numVars)]
+        self.unsatisfiable = False
+        # Orientação de cada célula já decidida (-1 se ainda não se sabe)
+        self.cellOrientation = [-1] * size
+        self.conflicts = 0
+        self.decisions = 0
+
+        self.buildClauses()
+
+    def buildClauses(self):
+        board = self.board
+        cells = board.cells
+        neighbours = board.neighbours
+
+        for index, variables in enumerate(self.cellVars):
+            # Pelo menos uma orientação ...
+            self.addClause([2 * var for _, var in variables])
+            # ... e no máximo uma
+            for first in range(len(variables)):
+                for second in range(first + 1, len(variables)):
+                    self.addClause([2 * variables[first][1] + 1, 2 * variables[second][1] + 1])
+
+            # Se esta orientação aponta para a vizinha, a vizinha tem de
+            # apontar para nós; se não aponta, a vizinha não pode apontar
+            pieceType = cells[index] >> 4
+            for side in range(4):
+                neighbour = neighbours[index][side]
+                if neighbour < 0:
+                    continue
+                neighbourType = cells[neighbour] >> 4
+                for orientation, var in variables:
+                    opens = bool(PIECE_MASKS[pieceType][orientation] & SIDE_BITS[side])
+                    clause = [2 * var + 1]
+                    for neighbourOrientation, neighbourVar in self.cellVars[neighbour]:
+                        facing = bool(PIECE_MASKS[neighbourType][neighbourOrientation] & FACING_BITS[side])
+                        if facing == opens:
+                            clause.append(2 * neighbourVar)
+                    self.addClause(clause)
+
+    def litValue(self, lit):
+        """1 se o literal é verdadeiro, 0 se é falso, -1 se não tem valor."""
+        value = self.value[lit >> 1]
+        if value < 0:
+            return -1
+        return value ^ (lit & 1)
+
+    def addClause(self, clause):
+        """Acrescenta uma cláusula ao nível 0 (antes da procura)."""
+        if self.unsatisfiable:
+            return
+        if len(clause) == 1:
+            value = self.litValue(clause[0])
+            if value == 0:
+                self.unsatisfiable = True
+            elif value < 0:
+                self.assign(clause[0], -1)
+            return
+        if not clause:
+            self.unsatisfiable = True
+            return
+        self.watchClause(clause)
+
+    def watchClause(self, clause):
+        clauseIndex = len(self.clauses)
+        self.clauses.append(clause)
+        self.watches[clause[0]].append(clauseIndex)
+        self.watches[clause[1]].append(clauseIndex)
+        return clauseIndex
+
+    def assign(self, lit, reason):
+        var = lit >> 1
+        self.value[var] = 1 - (lit & 1)
+        self.level[var] = len(self.trailLimits)
+        self.reason[var] = reason
+        self.trail.append(lit)
+        if not lit & 1:
+            self.cellOrientation[self.varCell[var]] = self.varOrientation[var]
+
+    def propagate(self):
+        """Propagação unitária com literais vigiados. Devolve o índice da
+        cláusula em conflito, ou -1."""
+        clauses = self.clauses
+        watches = self.watches
+        value = self.value
+        trail = self.trail
+
+        while self.propagateHead < len(trail):
+            falseLit = trail[self.propagateHead] ^ 1
+            self.propagateHead += 1
+            watching = watches[falseLit]
+            kept = []
+            position = 0
+            while position < len(watching):
+                clauseIndex = watching[position]
+                position += 1
+                clause = clauses[clauseIndex]
+                # O literal que ficou falso passa para a posição 1
+                if clause[0] == falseLit:
+                    clause[0], clause[1] = clause[1], falseLit
+                first = clause[0]
+                firstValue = value[first >> 1]
+                if firstValue >= 0 and firstValue ^ (first & 1):
+                    kept.append(clauseIndex)
+                    continue
+                # Procura outro literal que não seja falso para vigiar
+                for other in range(2, len(clause)):
+                    lit = clause[other]
+                    litValue = value[lit >> 1]
+                    if litValue < 0 or litValue ^ (lit & 1):
+                        clause[1], clause[other] = lit, falseLit
+                        watches[lit].append(clauseIndex)
+                        break
                 else:
-                    break
+                    kept.append(clauseIndex)
+                    if firstValue >= 0:
+                        # Todos os literais são falsos: conflito
+                        kept.extend(watching[position:])
+                        watches[falseLit] = kept
+                        return clauseIndex
+                    self.assign(first, clauseIndex)
+            watches[falseLit] = kept
+        return -1
+
+    def bumpActivity(self, var):
+        self.activity[var] += self.activityIncrement
+        if self.activity[var] > 1e100:
+            self.activity = [activity * 1e-100 for activity in self.activity]
+            self.activityIncrement *= 1e-100
+            self.heap = [(-self.activity[v], v) for v in range(len(self.activity)) if self.value[v] < 0]
+            heapq.heapify(self.heap)
+        elif self.value[var] < 0:
+            heapq.heappush(self.heap, (-self.activity[var], var))
+
+    def analyze(self, conflict):
+        """Análise de conflito até ao primeiro ponto de implicação único
+        (1UIP). Devolve a cláusula aprendida, com o literal a afirmar na
+        posição 0, e o nível para onde retroceder."""
+        seen = self.seen
+        level = self.level
+        currentLevel = len(self.trailLimits)
+        learnt = [0]
+        pending = 0
+        lit = -1
+        position = len(self.trail) - 1
+        clause = self.clauses[conflict]
+        touched = []
+
+        while True:
+            for other in clause:
+                if other == lit:
+                    continue
+                var = other >> 1
+                if not seen[var] and level[var] > 0:
+                    seen[var] = True
+                    touched.append(var)
+                    self.bumpActivity(var)
+                    if level[var] == currentLevel:
+                        pending += 1
+                    else:
+                        learnt.append(other)
+            # Próximo literal do nível atual envolvido no conflito
+            while not seen[self.trail[position] >> 1]:
+                position -= 1
+            lit = self.trail[position]
+            position -= 1
+            pending -= 1
+            if pending == 0:
+                break
+            clause = self.clauses[self.reason[lit >> 1]]
+
+        for var in touched:
+            seen[var] = False
+        learnt[0] = lit ^ 1
+        self.activityIncrement /= ACTIVITY_DECAY
+
+        backjumpLevel = 0
+        if len(learnt) > 1:
+            # O literal do nível mais alto (abaixo do atual) fica vigiado
+            best = max(range(1, len(learnt)), key=lambda i: level[learnt[i] >> 1])
+            learnt[1], learnt[best] = learnt[best], learnt[1]
+            backjumpLevel = level[learnt[1] >> 1]
+        return learnt, backjumpLevel
+
+    def cancelUntil(self, targetLevel):
+        if len(self.trailLimits) <= targetLevel:
+            return
+        limit = self.trailLimits[targetLevel]
+        for lit in reversed(self.trail[limit:]):
+            var = lit >> 1
+            self.value[var] = -1
+            self.reason[var] = -1
+            if not lit & 1:
+                self.cellOrientation[self.varCell[var]] = -1
+            heapq.heappush(self.heap, (-self.activity[var], var))
+        del self.trail[limit:]
+        del self.trailLimits[targetLevel:]
+        self.propagateHead = limit
+        self.checkHead = min(self.checkHead, limit)
+        fixedPositions = self.fixedPositions
+        while fixedPositions and fixedPositions[-1] >= limit:
+            fixedPositions.pop()
+        self.board.tracker.undo(len(fixedPositions))
+
+    def pickBranchVariable(self):
+        heap = self.heap
+        while heap:
+            _, var = heapq.heappop(heap)
+            if self.value[var] < 0:
+                return var
+        return -1
+
+    def connectivityConflict(self):
+        """Passa as peças decididas desde a última verificação para o
+        ConnectivityTracker do tabuleiro. Se alguma fechar uma componente
+        que não cobre o tabuleiro (ou um ciclo, se a solução tiver de ser
+        uma árvore), devolve a cláusula de explicação, já acrescentada à
+        base de cláusulas; caso contrário devolve -1."""
+        board = self.board
+        cells = board.cells
+        neighbours = board.neighbours
+        tracker = board.tracker
+        trail = self.trail
+
+        while self.checkHead < len(trail):
+            position = self.checkHead
+            self.checkHead += 1
+            lit = trail[position]
+            if lit & 1:
+                continue
+            index = self.varCell[lit >> 1]
+            if tracker.fixed[index]:
+                continue
+            cells[index] = ROTATION_TABLE[cells[index]][self.varOrientation[lit >> 1]]
+            self.fixedPositions.append(position)
+            if tracker.fix(index, cells, neighbours):
+                continue
+
+            # Pelo menos uma destas peças tem de ter outra orientação
+            clause = [2 * self.variableOf(cause, self.cellOrientation[cause]) + 1
+                      for cause in self.brokenCells(index)]
+            clause.sort(key=lambda lit: -self.level[lit >> 1])
+            if len(clause) == 1:
+                clause.append(clause[0])
+            return self.watchClause(clause)
+        return -1
+
+    def brokenCells(self, origin):
+        """Células da componente fechada a que origin pertence ou, se
+        origin fechou um ciclo, só as células desse ciclo."""
+        cells = self.board.cells
+        neighbours = self.board.neighbours
+        fixed = self.board.tracker.fixed
+        parent = {origin: -1}
+        stack = [origin]
+        while stack:
+            index = stack.pop()
+            mask = cells[index] & 15
+            for side in range(4):
+                neighbour = neighbours[index][side]
+                if not mask & SIDE_BITS[side] or not fixed[neighbour]:
+                    continue
+                if neighbour not in parent:
+                    parent[neighbour] = index
+                    stack.append(neighbour)
+                elif not self.board.tracker.allowCycles and parent[index] != neighbour:
+                    return self.cyclePath(parent, index, neighbour)
+        return list(parent)
+
+    def cyclePath(self, parent, first, second):
+        """Células do ciclo fechado pela ligação first-second da árvore de
+        procura descrita por parent."""
+        ancestors = []
+        index = first
+        while index != -1:
+            ancestors.append(index)
+            index = parent[index]
+        ancestorSet = set(ancestors)
+        path = []
+        index = second
+        while index not in ancestorSet:
+            path.append(index)
+            index = parent[index]
+        return ancestors[:ancestors.index(index) + 1] + path
+
+    def variableOf(self, index, orientation):
+        for cellOrientation, var in self.cellVars[index]:
+            if cellOrientation == orientation:
+                return var
+        return -1
+
+    def solve(self):
+        """Devolve o tabuleiro resolvido, ou None se não houver solução."""
+        if self.unsatisfiable:
+            return None
+        numVars = len(self.varCell)
+        self.seen = bytearray(numVars)
+        # Posição no trail de cada peça passada ao tracker, pela mesma ordem
+        # do registo do tracker (para o desfazer ao retroceder)
+        self.fixedPositions = []
+        self.board.tracker.history = []
+        heapq.heapify(self.heap)
+        restartIndex = 0
+        conflictsUntilRestart = RESTART_BASE * luby(restartIndex)
+
+        while True:
+            conflict = self.propagate()
+            if conflict < 0:
+                conflict = self.connectivityConflict()
+            if conflict >= 0:
+                self.conflicts += 1
+                # Uma cláusula de explicação pode só ter literais de níveis
+                # anteriores; a análise tem de começar no mais alto deles
+                conflictLevel = max(self.level[lit >> 1] for lit in self.clauses[conflict])
+                conflictsUntilRestart -= 1
+                if conflictLevel == 0:
+                    self.board.tracker.history = None
+                    return None
+                self.cancelUntil(conflictLevel)
+                learnt, backjumpLevel = self.analyze(conflict)
+                self.cancelUntil(backjumpLevel)
+                if len(learnt) == 1:
+                    self.assign(learnt[0], -1)
+                else:
+                    self.assign(learnt[0], self.watchClause(learnt))
+                continue
+
+            if conflictsUntilRestart <= 0:
+                restartIndex += 1
+                conflictsUntilRestart = RESTART_BASE * luby(restartIndex)
+                self.cancelUntil(0)
+                continue
+
+            var = self.pickBranchVariable()
+            if var < 0:
+                self.board.tracker.history = None
+                return self.writeSolution()
+            self.decisions += 1
+            self.trailLimits.append(len(self.trail))
+            self.assign(2 * var, -1)
+
+    def writeSolution(self):
+        board = self.board
+        for index, orientation in enumerate(self.cellOrientation):
+            if DOMAIN_SIZE[board.domains[index]] > 1:
+                board.fixCell(index, orientation)
+        board.pending = []
+        return board
 
-        # verifies if every pipe was visited, if not it means that there were found
-        # incompatible pipes or there are two or more different pipe structures.
-        return totalPieces == countPieces
 
-    def h(self, node: Node):
-        """Função heuristica utilizada para a procura A*."""
-        pass
+def luby(index):
+    """Termo index (a partir de 0) da sequência de Luby: 1 1 2 1 1 2 4 ..."""
+    size = 1
+    while size < index + 1:
+        size = 2 * size + 1
+    while size - 1 != index:
+        size = (size - 1) // 2
+        index = index % size
+    return (size + 1) // 2
 
-if __name__ == "__main__":
-    board = Board.parse_instance()
-    problem = PipeMania(board)
 
-    goal_node = breadth_first_tree_search(problem)
+def cdcl_search(problem: PipeMania):
+    """Propaga as restrições no tabuleiro inicial e resolve o resto com o
+    CDCLSolver. Devolve o tabuleiro inicial resolvido, ou None."""
+    board = problem.initial.board
+    board.testInference()
+    if board.cutBranch:
+        return None
+    solved = CDCLSolver(board).solve()
+    if solved is None or not problem.goal_test(problem.initial):
+        return None
+    return solved
+
+
+# Maior largura (a menor dimensão do tabuleiro) para a qual o modo portfolio
+# inclui o ProfileSolver, e número máximo de estados de uma fronteira antes de
+# este desistir (cerca de 300 bytes cada)
+PROFILE_MAX_WIDTH = 16
+PROFILE_MAX_STATES = 250000
+
+
+class ProfileSolver:
+    """Resolve um tabuleiro por programação dinâmica sobre o perfil (plug
+    DP), varrendo-o célula a célula ao longo da sua menor dimensão. O estado
+    entre a parte já decidida e a que falta é a fronteira: para cada posição
+    da linha, o rótulo da componente da peça acima se esta aponta para
+    baixo (0 se não aponta), e o mesmo para a ligação vinda da esquerda.
+    Peças com o mesmo rótulo já estão ligadas pela parte decidida; os
+    rótulos são renumerados por ordem de aparecimento, logo cada fronteira
+    tem uma única representação. Uma componente que deixa de tocar na
+    fronteira fica fechada, o que só é válido na última célula.
+
+    O número de estados de uma fronteira depende só da largura (e dos
+    domínios deixados pela propagação), não do comprimento do tabuleiro.
+    Para reconstruir a solução sem guardar todas as linhas, a primeira
+    passagem só guarda os estados do início de uma linha em cada
+    √comprimento (os pontos de controlo); a reconstrução, do fim para o
+    início, volta a varrer cada troço a partir do seu ponto de controlo e
+    só guarda as tabelas das linhas desse troço. Conta também as soluções
+    (solutions), o que permite verificar se são únicas.
+
+    Em tabuleiros largos o número de estados cresce depressa; se uma
+    fronteira passar de maxStates estados, solve desiste e marca gaveUp."""
+
+    def __init__(self, board: Board, maxStates=PROFILE_MAX_STATES):
+        self.board = board
+        self.maxStates = maxStates
+        self.gaveUp = False
+        # Varre por colunas se o tabuleiro for mais largo do que alto; os
+        # lados "acima", "esquerda", "abaixo" e "direita" da varredura mudam
+        self.byColumns = board.cols > board.rows
+        if self.byColumns:
+            self.width, self.length = board.rows, board.cols
+            self.sideBits = (SIDE_BITS[3], SIDE_BITS[0], SIDE_BITS[1], SIDE_BITS[2])
+        else:
+            self.width, self.length = board.cols, board.rows
+            self.sideBits = (SIDE_BITS[0], SIDE_BITS[3], SIDE_BITS[2], SIDE_BITS[1])
+        self.solutions = 0
+        self.states = 0
+
+    def cellIndex(self, line, position):
+        if self.byColumns:
+            return position * self.board.cols + line
+        return line * self.board.cols + position
+
+    def choices(self, index):
+        """Orientações ainda no domínio da célula, com os lados abertos."""
+        board = self.board
+        pieceType = board.cells[index] >> 4
+        return [(orientation, PIECE_MASKS[pieceType][orientation])
+                for orientation in DOMAIN_ORIENTATIONS[(pieceType << 4) | board.domains[index]]]
+
+    def solve(self):
+        """Devolve o tabuleiro resolvido (com a primeira solução encontrada)
+        ou None, e deixa em solutions o número de soluções."""
+        width, length = self.width, self.length
+        empty = (0,) * (width + 1)
+        step = max(1, int(length ** 0.5))
+        # Estados de fronteira -> [número de formas de lá chegar, estado
+        # anterior, orientação da célula]
+        layer = {empty: [1, None, -1]}
+        checkpoints = {}
+        for line in range(length):
+            if line % step == 0:
+                checkpoints[line] = list(layer)
+            layer = self.advance(layer, line)
+            if layer is None:
+                return None
+
+        final = layer.get(empty)
+        if final is None:
+            return None
+        self.solutions = final[0]
+
+        # Reconstrói a solução troço a troço, do último para o primeiro: o
+        # estado do fim de cada troço é o do início do troço seguinte
+        board = self.board
+        state = empty
+        for start in range((length - 1) // step * step, -1, -step):
+            stop = min(start + step, length)
+            layer = {checkpoint: [0, None, -1] for checkpoint in checkpoints.pop(start)}
+            rowTables = []
+            for line in range(start, stop):
+                rowTable = {}
+                layer = self.advance(layer, line, rowTable)
+                rowTables.append(rowTable)
+            for line in range(stop - 1, start - 1, -1):
+                state, orientations = rowTables[line - start][state]
+                for position, orientation in enumerate(orientations):
+                    index = self.cellIndex(line, position)
+                    if DOMAIN_SIZE[board.domains[index]] > 1:
+                        board.fixCell(index, orientation)
+        board.pending = []
+        return board
+
+    def advance(self, layer, line, rowTable=None):
+        """Avança a fronteira layer pelas células da linha line e devolve a
+        fronteira do fim da linha, ou None se nenhum estado sobreviver ou se
+        o solver desistir. Se rowTable for dado, guarda nele, para cada
+        estado do fim da linha, o estado do início e as orientações da
+        linha."""
+        width = self.width
+        upBit, leftBit, downBit, rightBit = self.sideBits
+        allowCycles = self.board.tracker.allowCycles
+        last = width * self.length - 1
+        cellTables = []
+        for position in range(width):
+            index = self.cellIndex(line, position)
+            choices = self.choices(index)
+            isLast = line * width + position == last
+            nextLayer = {}
+            for state, entry in layer.items():
+                up = state[position]
+                left = state[width]
+                for orientation, mask in choices:
+                    if (not mask & upBit) != (not up) or (not mask & leftBit) != (not left):
+                        continue
+                    labels = list(state)
+                    if up and left:
+                        if up == left:
+                            # A peça fecha um ciclo na sua componente
+                            if not allowCycles:
+                                continue
+                        else:
+                            labels = [up if label == left else label for label in labels]
+                        label = up
+                    else:
+                        label = up or left or width + 2
+                    labels[position] = label if mask & downBit else 0
+                    labels[width] = label if mask & rightBit else 0
+                    # A componente deixou de tocar na fronteira
+                    if not isLast and label not in labels:
+                        continue
+                    renumber = {}
+                    newState = tuple(renumber.setdefault(label, len(renumber) + 1) if label else 0
+                                     for label in labels)
+                    known = nextLayer.get(newState)
+                    if known is None:
+                        nextLayer[newState] = [entry[0], state, orientation]
+                    else:
+                        known[0] += entry[0]
+            if not nextLayer:
+                return None
+            self.states = max(self.states, len(nextLayer))
+            if len(nextLayer) > self.maxStates:
+                self.gaveUp = True
+                return None
+            if rowTable is not None:
+                cellTables.append(nextLayer)
+            layer = nextLayer
+
+        # Para cada estado do fim da linha, o estado do início e as
+        # orientações da linha; as tabelas das células são descartadas
+        if rowTable is not None:
+            for state in layer:
+                orientations = bytearray(width)
+                current = state
+                for position in range(width - 1, -1, -1):
+                    _, previous, orientation = cellTables[position][current]
+                    orientations[position] = orientation
+                    current = previous
+                rowTable[state] = (current, bytes(orientations))
+        return layer
+
+
+def profile_search(problem: PipeMania, countSolutions=False):
+    """Propaga as restrições no tabuleiro inicial e resolve o resto com o
+    ProfileSolver. Devolve o tabuleiro inicial resolvido, ou None; com
+    countSolutions, escreve no stderr o número de soluções."""
+    board = problem.initial.board
+    board.testInference()
+    if board.cutBranch:
+        solver = None
+        solved = None
+    else:
+        solver = ProfileSolver(board)
+        solved = solver.solve()
+    if solver is not None and solver.gaveUp:
+        print(f"profile: gave up after {solver.maxStates} states", file=sys.stderr)
+        return None
+    if countSolutions:
+        print(f"solutions: {solver.solutions if solver else 0}", file=sys.stderr)
+    if solved is None or not problem.goal_test(problem.initial):
+        return None
+    return solved
+
+
+def transform_cells(cells, symmetry):
+    """Aplica a simetria (espelho, rotações) à matriz numpy de códigos
+    cells: move as células e roda ou espelha cada peça da mesma forma."""
+    flip, turns = symmetry
+    if flip:
+        cells = CODE_FLIP_NP[cells[:, ::-1]]
+    for _ in range(turns):
+        cells = CODE_ROTATE_NP[np.rot90(cells, -1)]
+    return cells
+
+
+def untransform_cells(cells, symmetry):
+    """Inversa de transform_cells."""
+    flip, turns = symmetry
+    for _ in range(turns):
+        cells = CODE_UNROTATE_NP[np.rot90(cells, 1)]
+    if flip:
+        cells = CODE_FLIP_NP[cells[:, ::-1]]
+    return cells
+
+
+# Tamanho máximo, em bytes, da cache de soluções em disco
+DEFAULT_CACHE_BYTES = 256 << 20
+
+
+class SolutionCache:
+    """Cache persistente de soluções num diretório. A chave de um tabuleiro
+    só depende do tipo das peças (não das orientações dadas), logo o mesmo
+    tabuleiro com as peças rodadas de outra forma também é encontrado. Com
+    symmetries, a chave é a da menor das 8 simetrias do tabuleiro, que
+    encontra também as versões rodadas e espelhadas do tabuleiro todo.
+
+    Cada solução é guardada no formato binário, na orientação da simetria
+    canónica, e é convertida para a do tabuleiro pedido e verificada antes
+    de ser devolvida. Quando o diretório passa de maxBytes, são apagadas
+    as soluções usadas há mais tempo (a data de modificação de cada
+    ficheiro é atualizada sempre que a solução é usada)."""
+
+    def __init__(self, directory, maxBytes=DEFAULT_CACHE_BYTES, symmetries=False):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.symmetries = symmetries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, board: Board):
+        """Devolve (ficheiro da solução, simetria canónica) do tabuleiro."""
+        types = board.cellsArray() >> 4
+        best = None
+        for symmetry in (SYMMETRIES if self.symmetries else SYMMETRIES[:1]):
+            flip, turns = symmetry
+            grid = np.rot90(types[:, ::-1] if flip else types, -turns)
+            candidate = (grid.shape, np.ascontiguousarray(grid).tobytes())
+            if best is None or candidate < best[0]:
+                best = (candidate, symmetry)
+        (shape, typesBytes), symmetry = best
+        digest = hashlib.sha256(struct.pack('<II', *shape) + typesBytes).hexdigest()
+        return os.path.join(self.directory, digest + '.pipe'), symmetry
+
+    def lookup(self, board: Board):
+        """Devolve uma cópia do tabuleiro resolvida com a solução guardada,
+        ou None se não houver nenhuma (ou se não passar na verificação)."""
+        path, symmetry = self.key(board)
+        try:
+            cached = Board.load_binary(path, prepare=False)
+        except (OSError, ValueError):
+            return None
+        cells = untransform_cells(cached.cellsArray(), symmetry)
+        if cells.shape != (board.rows, board.cols):
+            return None
+        solved = board.applySolution(cells.tobytes())
+        if solved is None:
+            return None
+        os.utime(path)
+        return solved
+
+    def store(self, board: Board, solved: Board):
+        """Guarda a solução solved do tabuleiro board e apaga as soluções
+        mais antigas se a cache ficar grande demais."""
+        path, symmetry = self.key(board)
+        canonical = transform_cells(solved.cellsArray(), symmetry)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as output:
+            Board(bytearray(canonical.tobytes()), *canonical.shape).write_binary(output)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pipe'):
+                status = entry.stat()
+                entries.append((status.st_mtime, status.st_size, entry.path))
+                total += status.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+SEARCHES = {
+    'bfs': breadth_first_tree_search,
+    'dfs': depth_first_tree_search,
+    'bfs-graph': breadth_first_graph_search,
+    'dfs-graph': depth_first_graph_search,
+    'astar': astar_search,
+    'greedy': greedy_search,
+    'rbfs': recursive_best_first_search,
+}
+# Procuras de SEARCHES que podem dispensar os pais dos nós (a rbfs guarda-os
+# de qualquer forma na pilha de recursão)
+PATHLESS_SEARCHES = ('bfs', 'dfs', 'bfs-graph', 'dfs-graph', 'astar', 'greedy')
+
+# Estratégias do modo portfolio: nome e opções da linha de comandos que
+# substitui. As que assumem uma árvore (spanning_tree) só servem para
+# encontrar depressa uma solução; se falharem não provam que não há solução
+PORTFOLIO = (
+    ('trail', {'search': 'trail'}),
+    ('trail-tree', {'search': 'trail', 'spanning_tree': True}),
+    ('trail-mrv-tree', {'search': 'trail', 'branching': 'mrv', 'spanning_tree': True}),
+    ('cdcl', {'search': 'cdcl'}),
+    ('profile', {'search': 'profile'}),
+    ('greedy-tree', {'search': 'greedy', 'spanning_tree': True}),
+    ('dfs', {'search': 'dfs'}),
+)
 
-    if goal_node:
-        print(goal_node.state.board.__str__())
+
+def solve_board(board: Board, options):
+    """Configura o tabuleiro com as opções da linha de comandos e resolve-o
+    com a procura escolhida, consultando primeiro a cache de soluções se
+    options.cache indicar um diretório. Devolve o tabuleiro resolvido, ou
+    None."""
+    if options.cache:
+        cache = SolutionCache(options.cache, options.cache_size, options.cache_symmetries)
+        solved = cache.lookup(board)
+        if solved is None:
+            options = argparse.Namespace(**vars(options))
+            options.cache = None
+            original = board.copy()
+            solved = solve_board(board, options)
+            if solved is not None:
+                cache.store(original, solved)
+        return solved
+
+    board.propagation = options.propagation
+    board.tracker.allowCycles = not options.spanning_tree
+    board.globalConnectivity = options.global_connectivity
+    board.branching = options.branching
+    if options.analysis:
+        reasons = board.feasibilityReport()
+        if reasons:
+            for reason in reasons:
+                print(f"unsolvable: {reason}", file=sys.stderr)
+            return None
+    problem = PipeMania(board, options.shared_states, options.check_heuristic)
+
+    if options.search == 'trail':
+        return depth_first_trail_search(problem)
+    if options.search == 'cdcl':
+        return cdcl_search(problem)
+    if options.search == 'profile':
+        return profile_search(problem, options.count_solutions)
+    if options.search == 'region':
+        return region_search(problem, options.workers)
+    if options.search == 'portfolio':
+        return portfolio_search(board, options)
+    if options.search == 'parallel':
+        goal_node = parallel_depth_first_tree_search(problem, options.workers)
+        return goal_node.state.board if goal_node else None
+    # Só interessa o tabuleiro final, logo os nós não guardam o caminho
+    if options.search in PATHLESS_SEARCHES:
+        goal_node = SEARCHES[options.search](problem, keep_path=False)
+    else:
+        goal_node = SEARCHES[options.search](problem)
+    return goal_node.state.board if goal_node else None
+
+
+def portfolio_worker(board: Board, options, name, connection):
+    """Processo do modo portfolio: resolve o tabuleiro com as opções da
+    estratégia name e envia pela ligação as células resolvidas (ou None),
+    mesmo que a estratégia lance uma exceção."""
+    solved = None
+    try:
+        solved = solve_board(board, options)
+    except Exception as error:
+        print(f"portfolio: {name} failed: {error!r}", file=sys.stderr)
+    finally:
+        connection.send(bytes(solved.cells) if solved else None)
+        connection.close()
+
+
+def portfolio_search(board: Board, options):
+    """Lança as estratégias de PORTFOLIO escolhidas em options.portfolio,
+    cada uma no seu processo e sobre o mesmo tabuleiro inicial, e fica com
+    a primeira solução que passar na verificação de raiz; as restantes
+    são terminadas. A estratégia vencedora é indicada no stderr. Devolve o
+    tabuleiro resolvido, ou None se todas terminarem sem solução. Um
+    processo que morre sem dar resposta (por exemplo, terminado por falta
+    de memória) conta como uma estratégia que terminou sem solução."""
+    strategies = dict(PORTFOLIO)
+    names = options.portfolio
+    if not names:
+        # O ProfileSolver só compensa (e só cabe em memória) em tabuleiros estreitos
+        names = [name for name, _ in PORTFOLIO
+                 if name != 'profile' or min(board.rows, board.cols) <= PROFILE_MAX_WIDTH]
+    names = list(dict.fromkeys(names))
+    context = multiprocessing.get_context()
+    # Estratégias ainda sem resposta: nome -> (ligação, processo)
+    waiting = {}
+    for name in names:
+        strategyOptions = argparse.Namespace(**vars(options))
+        vars(strategyOptions).update(strategies[name])
+        strategyOptions.cache = None
+        connection, child = context.Pipe(duplex=False)
+        process = context.Process(target=portfolio_worker, daemon=True,
+                                  args=(board.copy(), strategyOptions, name, child))
+        process.start()
+        child.close()
+        waiting[name] = (connection, process)
+    processes = [process for _, process in waiting.values()]
+
+    start = time.perf_counter()
+    solved = None
+    try:
+        while waiting and solved is None:
+            # Espera pela resposta de uma estratégia ou pelo fim do seu
+            # processo, para detetar os que morrem sem responder
+            owners = {}
+            for name, (connection, process) in waiting.items():
+                owners[connection] = name
+                owners[process.sentinel] = name
+            ready = multiprocessing.connection.wait(list(owners))
+            for name in dict.fromkeys(owners[handle] for handle in ready):
+                connection, process = waiting.pop(name)
+                try:
+                    # Só este processo tinha a outra ponta da ligação, logo
+                    # se morreu sem responder a leitura chega ao fim
+                    cells = connection.recv()
+                except (EOFError, OSError):
+                    process.join()
+                    print(f"portfolio: {name} died (exit code {process.exitcode})", file=sys.stderr)
+                    continue
+                finally:
+                    connection.close()
+                if cells is None:
+                    continue
+                candidate = board.applySolution(cells)
+                if candidate is not None:
+                    print(f"portfolio: {name} won in {time.perf_counter() - start:.2f}s",
+                          file=sys.stderr)
+                    solved = candidate
+                    break
+    finally:
+        for connection, _ in waiting.values():
+            connection.close()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    return solved
+
+
+def is_binary_instance(path):
+    """Verifica se o ficheiro em path começa pela assinatura do formato binário."""
+    with open(path, 'rb') as instance:
+        return instance.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def load_instance(path):
+    """Lê o tabuleiro do ficheiro em path, em formato binário ou de texto."""
+    if is_binary_instance(path):
+        return Board.load_binary(path)
+    with open(path, 'rb') as instance:
+        return Board.parse_bytes(instance.read())
+
+
+def convert_instance(source, target):
+    """Converte o tabuleiro em source para o outro formato (texto para
+    binário ou binário para texto) e escreve-o em target."""
+    if is_binary_instance(source):
+        board = Board.load_binary(source, prepare=False)
+        with open(target, 'wb') as output:
+            board.write(output)
+    else:
+        with open(source, 'rb') as instance:
+            board = Board.parse_bytes(instance.read(), prepare=False)
+        with open(target, 'wb') as output:
+            board.write_binary(output)
+
+
+def stream_instances(stream, streamFormat='auto'):
+    """Lê do stream um tabuleiro de cada vez, sem guardar os seguintes.
+    No formato 'blank' os tabuleiros estão separados por linhas em branco;
+    no formato 'jsonl' cada linha é um objeto JSON com o tabuleiro em
+    "board" (texto, ou lista de linhas) e, opcionalmente, um "id". Com
+    'auto', o formato é escolhido pela primeira linha não vazia. Devolve
+    pares (objeto JSON ou None, linhas do tabuleiro); uma linha JSONL
+    inválida (JSON malformado, sem "board") dá o par (objeto ou {}, exceção
+    ValueError), para quem lê poder registar o erro e continuar."""
+    lines = []
+    for line in stream:
+        if not line.strip():
+            if lines:
+                yield None, lines
+                lines = []
+            continue
+        if streamFormat == 'auto':
+            streamFormat = 'jsonl' if line.lstrip().startswith('{') else 'blank'
+        if streamFormat == 'blank':
+            lines.append(line)
+            continue
+        instance = {}
+        try:
+            instance = json.loads(line)
+            if not isinstance(instance, dict):
+                instance = {}
+                raise ValueError("a linha não é um objeto JSON")
+            if 'board' not in instance:
+                raise ValueError('objeto sem "board"')
+            board = instance['board']
+            if isinstance(board, str):
+                board = board.splitlines()
+            else:
+                board = [row if isinstance(row, str) else ' '.join(row) for row in board]
+        except (ValueError, TypeError) as error:
+            yield instance, ValueError(str(error))
+            continue
+        yield instance, board
+    if lines:
+        yield None, lines
+
+
+def stream_solve(options, stream=sys.stdin, output=sys.stdout):
+    """Resolve cada tabuleiro de stream_instances e escreve logo a sua
+    solução, mantendo em memória só o tabuleiro atual. No formato 'blank'
+    as soluções saem separadas por linhas em branco; no 'jsonl' sai uma
+    linha JSON por tabuleiro com o "id" (ou o número do tabuleiro), o
+    "status" e a "solution". Devolve o número de tabuleiros sem solução."""
+    unsolved = 0
+    for number, (instance, lines) in enumerate(stream_instances(stream, options.stream_format)):
+        try:
+            if isinstance(lines, Exception):
+                raise lines
+            solved = solve_board(Board.parse_lines(lines), options)
+            status = 'solved' if solved else 'unsolved'
+            text = solved.__str__() if solved else None
+        except Exception as error:
+            solved = None
+            status, text = 'error', f"{type(error).__name__}: {error}"
+        if not solved:
+            unsolved += 1
+
+        if instance is None:
+            if status == 'error':
+                print(f"board {number}: {text}", file=sys.stderr)
+            if number:
+                output.write('\n')
+            output.write((text if status == 'solved' else "No solution found.") + '\n')
+        else:
+            result = {'id': instance.get('id', number), 'status': status}
+            if status == 'solved':
+                result['solution'] = text
+            elif status == 'error':
+                result['error'] = text
+            output.write(json.dumps(result) + '\n')
+        output.flush()
+    return unsolved
+
+
+def batch_worker(connection, options):
+    """Processo do modo batch: recebe (trabalho, caminho) pela ligação,
+    resolve o tabuleiro do ficheiro e responde com (trabalho, estado,
+    texto da solução, segundos). Termina quando recebe None."""
+    # Grupo de processos próprio, para que stop_batch_worker termine também
+    # os processos lançados pelas procuras 'portfolio', 'parallel' e 'region'
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        jobIndex, path = job
+        start = time.perf_counter()
+        try:
+            board = load_instance(path)
+            solved = solve_board(board, options)
+            if solved:
+                status, text = 'solved', solved.__str__()
+            else:
+                status, text = 'unsolved', "No solution found."
+        except Exception as error:
+            status, text = 'error', f"{type(error).__name__}: {error}"
+        connection.send((jobIndex, status, text, time.perf_counter() - start))
+
+
+def stop_batch_worker(process):
+    """Termina um processo do modo batch e todos os que ele lançou."""
+    if hasattr(os, 'killpg') and process.is_alive():
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            process.terminate()
+    else:
+        process.terminate()
+    process.join()
+
+
+def batch_paths(patterns):
+    """Expande diretórios (todos os .txt lá dentro) e padrões glob numa
+    lista ordenada e sem repetições de ficheiros de instâncias."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.txt')
+        paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def batch_output_path(path, outputDir):
+    """Ficheiro .out da instância em path: ao lado dela ou em outputDir."""
+    name = os.path.splitext(os.path.basename(path))[0] + '.out'
+    if outputDir is None:
+        return os.path.join(os.path.dirname(path), name)
+    return os.path.join(outputDir, name)
+
+
+def batch_solve(paths, options, report=sys.stderr):
+    """Resolve os tabuleiros dos ficheiros em paths num conjunto de
+    options.jobs processos, pagando o arranque do Python e do numpy uma só
+    vez por processo. Cada solução é escrita no seu ficheiro .out e o
+    relatório (caminho, estado, segundos) sai pela ordem de paths.
+
+    Um processo que exceda options.timeout segundos num tabuleiro, ou que
+    morra a meio, é substituído por um novo e o tabuleiro fica com o estado
+    'timeout' ou 'crashed'. Devolve a lista dos estados pela ordem de paths."""
+    if options.output_dir is not None:
+        os.makedirs(options.output_dir, exist_ok=True)
+    context = multiprocessing.get_context()
+    results = [None] * len(paths)
+    nextJob = 0
+    nextReport = 0
+    # Processos ativos: ligação -> [processo, trabalho atual, início]
+    workers = {}
+
+    def spawn():
+        # Não é daemon para poder lançar os processos das procuras
+        # 'portfolio', 'parallel' e 'region'; é terminado explicitamente
+        # quando excede o tempo ou no fim
+        connection, child = context.Pipe()
+        process = context.Process(target=batch_worker, args=(child, options))
+        process.start()
+        child.close()
+        workers[connection] = [process, None, 0.0]
+
+    def finish(jobIndex, status, text, seconds):
+        nonlocal nextReport
+        results[jobIndex] = (status, seconds)
+        if status in ('solved', 'unsolved'):
+            with open(batch_output_path(paths[jobIndex], options.output_dir), 'w') as output:
+                output.write(text + '\n')
+        elif status == 'error':
+            results[jobIndex] = (f"{status} ({text})", seconds)
+        # O relatório segue a ordem dos ficheiros, não a de conclusão
+        while nextReport < len(paths) and results[nextReport] is not None:
+            status, seconds = results[nextReport]
+            print(f"{paths[nextReport]}\t{status}\t{seconds:.2f}", file=report, flush=True)
+            nextReport += 1
+
+    for _ in range(min(max(options.jobs, 1), len(paths))):
+        spawn()
+    try:
+        while nextReport < len(paths):
+            # Dá trabalho aos processos livres
+            for connection, worker in workers.items():
+                if worker[1] is None and nextJob < len(paths):
+                    connection.send((nextJob, paths[nextJob]))
+                    worker[1] = nextJob
+                    worker[2] = time.perf_counter()
+                    nextJob += 1
+
+            timeout = None
+            if options.timeout is not None:
+                now = time.perf_counter()
+                timeout = max(0.0, min((options.timeout - (now - worker[2])
+                                        for worker in workers.values() if worker[1] is not None),
+                                       default=options.timeout))
+            sentinels = {worker[0].sentinel: connection for connection, worker in workers.items()}
+            ready = multiprocessing.connection.wait(list(workers) + list(sentinels), timeout)
+
+            replaced = []
+            for connection, worker in workers.items():
+                process, jobIndex, start = worker
+                if connection in ready and connection.poll():
+                    try:
+                        finish(*connection.recv())
+                        worker[1] = None
+                        continue
+                    except (EOFError, OSError):
+                        pass
+                if not process.is_alive():
+                    if jobIndex is not None:
+                        finish(jobIndex, 'crashed', '', time.perf_counter() - start)
+                    replaced.append(connection)
+                elif (jobIndex is not None and options.timeout is not None
+                      and time.perf_counter() - start >= options.timeout):
+                    stop_batch_worker(process)
+                    finish(jobIndex, 'timeout', '', time.perf_counter() - start)
+                    replaced.append(connection)
+
+            for connection in replaced:
+                del workers[connection]
+                connection.close()
+                if nextJob < len(paths):
+                    spawn()
+
+        for connection, worker in workers.items():
+            connection.send(None)
+            worker[0].join()
+            connection.close()
+        workers.clear()
+    finally:
+        # Se o ciclo foi interrompido, os processos que restam não podem
+        # ficar a impedir o fim do programa
+        for connection, worker in workers.items():
+            stop_batch_worker(worker[0])
+            connection.close()
+    return [status for status, _ in results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resolve um tabuleiro de PipeMania lido do stdin.")
+    parser.add_argument("--propagation", choices=PROPAGATION_MODES, default='worklist',
+                        help="motor de propagação de restrições")
+    parser.add_argument("--search", choices=('bfs', 'dfs', 'bfs-graph', 'dfs-graph', 'astar', 'greedy', 'rbfs',
+                                 'trail', 'cdcl', 'profile', 'region', 'portfolio', 'parallel'),
+                        default='bfs',
+                        help="procura do search.py sobre cópias do tabuleiro, ('trail') procura em "
+                             "profundidade que altera o tabuleiro no próprio sítio, ('cdcl') "
+                             "resolução com aprendizagem de cláusulas, ('profile') programação "
+                             "dinâmica sobre o perfil, linha a linha, ('region') procura "
+                             "'trail' em cada região separada por peças fixas, ('portfolio') "
+                             "várias estratégias em paralelo, ou ('parallel') procura em "
+                             "profundidade repartida por vários processos")
+    parser.add_argument("--count-solutions", action='store_true',
+                        help="com --search profile, escreve no stderr o número de soluções")
+    parser.add_argument("--portfolio", nargs='+', choices=[name for name, _ in PORTFOLIO],
+                        help="estratégias do modo portfolio (por omissão, todas)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="número de processos para resolver as regiões ou para a procura 'parallel'")
+    parser.add_argument("--spanning-tree", action='store_true',
+                        help="assume que a solução não tem ciclos e corta os ramos que os fecham")
+    parser.add_argument("--global-connectivity", action='store_true',
+                        help="propaga também a conectividade do grafo das ligações ainda possíveis")
+    parser.add_argument("--branching", choices=BRANCHING_POLICIES, default='row-major',
+                        help="política de escolha da célula onde ramificar")
+    parser.add_argument("--shared-states", action='store_true',
+                        help="os estados da fronteira partilham com o pai os blocos do tabuleiro "
+                             "que não mudaram")
+    parser.add_argument("--check-heuristic", action='store_true',
+                        help="verifica em cada avaliação da heurística (astar, greedy, rbfs) o valor "
+                             "incremental contra o recalculado de raiz")
+    parser.add_argument("--no-analysis", dest='analysis', action='store_false',
+                        help="não faz a análise que rejeita tabuleiros sem solução antes da procura")
+    parser.add_argument("--batch", nargs='+', metavar="PATH",
+                        help="resolve os .txt destes diretórios ou padrões glob em vez do stdin, "
+                             "escrevendo cada solução num ficheiro .out")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="número de processos do modo batch")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="limite em segundos para cada tabuleiro do modo batch")
+    parser.add_argument("--output-dir", default=None,
+                        help="diretório dos .out do modo batch (por omissão, ao lado de cada .txt)")
+    parser.add_argument("--stream", action='store_true',
+                        help="lê vários tabuleiros do stdin e escreve cada solução mal é encontrada")
+    parser.add_argument("--stream-format", choices=('auto', 'blank', 'jsonl'), default='auto',
+                        help="tabuleiros separados por linhas em branco, ou um objeto JSON por linha")
+    parser.add_argument("--input", metavar="PATH",
+                        help="lê o tabuleiro deste ficheiro (texto ou binário) em vez do stdin")
+    parser.add_argument("--binary-output", metavar="PATH",
+                        help="escreve a solução neste ficheiro, no formato binário")
+    parser.add_argument("--convert", nargs=2, metavar=("SOURCE", "TARGET"),
+                        help="converte um tabuleiro de texto para binário ou vice-versa e termina")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="diretório da cache persistente de soluções")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_BYTES,
+                        help="tamanho máximo da cache de soluções, em bytes")
+    parser.add_argument("--cache-symmetries", action='store_true',
+                        help="reconhece na cache as versões rodadas e espelhadas de cada tabuleiro")
+    args = parser.parse_args()
+
+    if args.convert:
+        convert_instance(*args.convert)
+        sys.exit(0)
+
+    if args.stream:
+        sys.exit(1 if stream_solve(args) else 0)
+
+    if args.batch:
+        statuses = batch_solve(batch_paths(args.batch), args)
+        sys.exit(0 if all(status == 'solved' for status in statuses) else 1)
+
+    board = load_instance(args.input) if args.input else Board.parse_instance()
+    solved = solve_board(board, args)
+
+    if solved and args.binary_output:
+        with open(args.binary_output, 'wb') as output:
+            solved.write_binary(output)
+    elif solved:
+        solved.write(sys.stdout.buffer)
     else:
-        print("No solution found.")
\ No newline at end of file
+        print("No solution found.")
@@ -6,6 +6,9 @@ then create problem instances and solve them with calls to the various search
 functions.
 """
 
+import multiprocessing
+import os
+import queue
 import sys
 from collections import deque
 
@@ -73,7 +76,12 @@ class Node:
     the total path_cost (also known as g) to reach the node. Other functions
     may add an f and h value; see best_first_graph_search and astar_search for
     an explanation of how the f and h values are handled. You will not need to
-    subclass this class."""
+    subclass this class.
+
+    Nodes use __slots__ instead of a per-instance dict; f and h have slots
+    of their own, left unset until a search stores them."""
+
+    __slots__ = ('state', 'parent', 'action', 'path_cost', 'depth', 'f', 'h')
 
     def __init__(self, state, parent=None, action=None, path_cost=0):
         """Create a search tree Node, derived from a parent by an action."""
@@ -130,6 +138,28 @@ class Node:
         return hash(self.state)
 
 
+class PathlessNode(Node):
+    """A Node that does not keep its parent, for searches where only the goal
+    state matters: each node keeps its depth and path_cost, but not the chain
+    of ancestors (and their states) that led to it, so the memory of a search
+    grows with the frontier alone. solution() and path() only see the node
+    itself."""
+
+    __slots__ = ()
+
+    def child_node(self, problem, action):
+        next_state = problem.result(self.state, action)
+        next_node = PathlessNode(next_state, None, action,
+                                 problem.path_cost(self.path_cost, self.state, action, next_state))
+        next_node.depth = self.depth + 1
+        return next_node
+
+
+def root_node(problem, keep_path=True):
+    """The root Node of a search; with keep_path=False, a PathlessNode."""
+    return Node(problem.initial) if keep_path else PathlessNode(problem.initial)
+
+
 # ______________________________________________________________________________
 
 
@@ -175,16 +205,17 @@ class SimpleProblemSolvingAgentProgram:
 # Uninformed Search algorithms
 
 
-def breadth_first_tree_search(problem):
+def breadth_first_tree_search(problem, keep_path=True):
     """
     [Figure 3.7]
     Search the shallowest nodes in the search tree first.
     Search through the successors of a problem to find a goal.
     The argument frontier should be an empty queue.
     Repeats infinitely in case of loops.
+    With keep_path=False the nodes do not keep their parents (PathlessNode).
     """
 
-    frontier = deque([Node(problem.initial)])  # FIFO queue
+    frontier = deque([root_node(problem, keep_path)])  # FIFO queue
 
     while frontier:
         node = frontier.popleft()
@@ -194,16 +225,17 @@ def breadth_first_tree_search(problem):
     return None
 
 
-def depth_first_tree_search(problem):
+def depth_first_tree_search(problem, keep_path=True):
     """
     [Figure 3.7]
     Search the deepest nodes in the search tree first.
     Search through the successors of a problem to find a goal.
     The argument frontier should be an empty queue.
     Repeats infinitely in case of loops.
+    With keep_path=False the nodes do not keep their parents (PathlessNode).
     """
 
-    frontier = [Node(problem.initial)]  # Stack
+    frontier = [root_node(problem, keep_path)]  # Stack
 
     while frontier:
         node = frontier.pop()
@@ -213,7 +245,7 @@ def depth_first_tree_search(problem):
     return None
 
 
-def depth_first_graph_search(problem):
+def depth_first_graph_search(problem, keep_path=True):
     """
     [Figure 3.7]
     Search the deepest nodes in the search tree first.
@@ -221,8 +253,9 @@ def depth_first_graph_search(problem):
     The argument frontier should be an empty queue.
     Does not get trapped by loops.
     If two paths reach a state, only use the first one.
+    With keep_path=False the nodes do not keep their parents (PathlessNode).
     """
-    frontier = [(Node(problem.initial))]  # Stack
+    frontier = [(root_node(problem, keep_path))]  # Stack
 
     explored = set()
     while frontier:
@@ -235,13 +268,14 @@ def depth_first_graph_search(problem):
     return None
 
 
-def breadth_first_graph_search(problem):
+def breadth_first_graph_search(problem, keep_path=True):
     """[Figure 3.11]
     Note that this function can be implemented in a
     single line as below:
     return graph_search(problem, FIFOQueue())
+    With keep_path=False the nodes do not keep their parents (PathlessNode).
     """
-    node = Node(problem.initial)
+    node = root_node(problem, keep_path)
     if problem.goal_test(node.state):
         return node
     frontier = deque([node])
@@ -257,16 +291,17 @@ def breadth_first_graph_search(problem):
     return None
 
 
-def best_first_graph_search(problem, f, display=False):
+def best_first_graph_search(problem, f, display=False, keep_path=True):
     """Search the nodes with the lowest f scores first.
     You specify the function f(node) that you want to minimize; for example,
     if f is a heuristic estimate to the goal, then we have greedy best
     first search; if f is node.depth then we have breadth-first search.
     There is a subtlety: the line "f = memoize(f, 'f')" means that the f
     values will be cached on the nodes as they are computed. So after doing
-    a best first search you can examine the f values of the path returned."""
+    a best first search you can examine the f values of the path returned.
+    With keep_path=False the nodes do not keep their parents (PathlessNode)."""
     f = memoize(f, 'f')
-    node = Node(problem.initial)
+    node = root_node(problem, keep_path)
     frontier = PriorityQueue('min', f)
     frontier.append(node)
     explored = set()
@@ -322,6 +357,129 @@ def iterative_deepening_search(problem):
             return result
 
 
+# ______________________________________________________________________________
+# Parallel Search
+
+
+def replay_solution(problem, actions):
+    """Rebuild the search tree path that the given sequence of actions
+    follows from problem.initial, returning its last Node. Each node is
+    expanded the same way as in the search (problem.actions is called before
+    problem.result), so problems whose actions also prepare the state get
+    back exactly the states the search saw."""
+    node = Node(problem.initial)
+    for action in actions:
+        problem.actions(node.state)
+        node = node.child_node(problem, action)
+    return node
+
+
+def _parallel_search_worker(problem, tasks, results, outstanding, hungry, stop, steal_interval):
+    """Worker of parallel_depth_first_tree_search. Each task is the list of
+    actions leading from problem.initial to a subtree root; the worker
+    replays it and searches the subtree depth-first. Every steal_interval
+    expansions, if some worker is idle, the shallowest node of the local
+    frontier is handed back to the task queue. The task is always counted
+    as finished, even if the problem raises (the worker then dies and the
+    parent stops the search)."""
+    while not stop.is_set():
+        try:
+            actions = tasks.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        with hungry.get_lock():
+            hungry.value = max(0, hungry.value - 1)
+
+        try:
+            frontier = deque([replay_solution(problem, actions)])
+            expansions = 0
+            while frontier and not stop.is_set():
+                node = frontier.pop()
+                if problem.goal_test(node.state):
+                    results.put(node.solution())
+                    stop.set()
+                    return
+                frontier.extend(node.expand(problem))
+                expansions += 1
+                if expansions % steal_interval == 0 and len(frontier) > 1 and hungry.value > 0:
+                    with outstanding.get_lock():
+                        outstanding.value += 1
+                    tasks.put(frontier.popleft().solution())
+        finally:
+            with outstanding.get_lock():
+                outstanding.value -= 1
+        with hungry.get_lock():
+            hungry.value += 1
+
+
+def parallel_depth_first_tree_search(problem, workers=None, tasks_per_worker=4, steal_interval=64):
+    """Depth-first tree search spread over worker processes. The top of the
+    tree is expanded breadth-first until there are about tasks_per_worker
+    subtrees per worker; each subtree is sent to the workers as the actions
+    that lead to it, so only the problem and action sequences need to be
+    pickled. Idle workers steal further splits from busy ones, and all of
+    them stop as soon as one finds a goal, whose Node is rebuilt here by
+    replaying its actions. Like depth_first_tree_search, it only needs the
+    Problem/Node interface and returns None if there is no goal. If a worker
+    dies (for instance because the problem raised), part of the tree was
+    not searched, so a RuntimeError is raised instead."""
+    workers = workers or os.cpu_count() or 1
+
+    frontier = deque([Node(problem.initial)])
+    while frontier and len(frontier) < workers * tasks_per_worker:
+        node = frontier.popleft()
+        if problem.goal_test(node.state):
+            return node
+        frontier.extend(node.expand(problem))
+    if not frontier:
+        return None
+
+    context = multiprocessing.get_context()
+    tasks = context.Queue()
+    results = context.Queue()
+    outstanding = context.Value('i', len(frontier))
+    hungry = context.Value('i', 0)
+    stop = context.Event()
+    for node in frontier:
+        tasks.put(node.solution())
+
+    processes = [context.Process(target=_parallel_search_worker, daemon=True,
+                                 args=(problem, tasks, results, outstanding, hungry, stop, steal_interval))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    solution = None
+    failed = []
+    try:
+        while solution is None:
+            try:
+                solution = results.get(timeout=0.05)
+            except queue.Empty:
+                failed = [process.exitcode for process in processes
+                          if process.exitcode not in (None, 0)]
+                if failed:
+                    break
+                # Every subtree has been searched without finding a goal
+                if outstanding.value == 0 or not any(process.is_alive() for process in processes):
+                    break
+    finally:
+        stop.set()
+        # The subtrees still queued are dropped with the queue
+        tasks.cancel_join_thread()
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    if failed:
+        raise RuntimeError(f"parallel search worker exited with code {failed[0]}")
+    if solution is None:
+        return None
+    return replay_solution(problem, solution)
+
+
 # ______________________________________________________________________________
 # Bidirectional Search
 # Pseudocode from https://webdocs.cs.ualberta.ca/%7Eholte/Publications/MM-AAAI2016.pdf
@@ -410,17 +568,17 @@ greedy_best_first_graph_search = best_first_graph_search
 
 
 # Greedy best-first search is accomplished by specifying f(n) = h(n).
-def greedy_search(problem, h=None):
+def greedy_search(problem, h=None, keep_path=True):
     """f(n) = h(n)"""
     h = memoize(h or problem.h, 'h')
-    return best_first_graph_search(problem, h)
+    return best_first_graph_search(problem, h, keep_path=keep_path)
 
-def astar_search(problem, h=None, display=False):
+def astar_search(problem, h=None, display=False, keep_path=True):
     """A* search is best-first graph search with f(n) = g(n)+h(n).
     You need to specify the h function when you call astar_search, or
     else in your Problem subclass."""
     h = memoize(h or problem.h, 'h')
-    return best_first_graph_search(problem, lambda n: n.path_cost + h(n), display)
+    return best_first_graph_search(problem, lambda n: n.path_cost + h(n), display, keep_path)
 
 
 # ______________________________________________________________________________